@@ -0,0 +1,123 @@
+"""An in-process stand-in for the parts of `bigquery.Client` used by `persist_lines_*`, with
+injectable latency and errors, which counts every API call made against it"""
+
+import collections
+import random
+import threading
+import uuid
+from time import sleep
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+
+def table_path(table):
+    if isinstance(table, str):
+        return table
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+class FakeLoadJob:
+    def __init__(self, client, output_rows):
+        self.client = client
+        self.job_id = str(uuid.uuid4())
+        self.output_rows = output_rows
+
+    def result(self):
+        self.client.call("load_job.result")
+        return self
+
+
+class FakeClient:
+    """Keeps tables in memory. `latency` seconds are added to every call, `error_rate` is the
+    fraction of `insert_rows_json` calls which fail with a retryable error and `row_error_rate`
+    the fraction which return row errors instead"""
+
+    def __init__(
+        self,
+        project="fake-project",
+        location=None,
+        latency=0,
+        error_rate=0,
+        row_error_rate=0,
+        seed=0,
+    ):
+        self.project = project
+        self.location = location
+        self.latency = latency
+        self.error_rate = error_rate
+        self.row_error_rate = row_error_rate
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.tables = {}
+        self.rows = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def call(self, method):
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.call("create_dataset")
+        if isinstance(dataset, bigquery.DatasetReference):
+            dataset = bigquery.Dataset(dataset)
+        return dataset
+
+    def get_table(self, table):
+        self.call("get_table")
+        try:
+            return self.tables[table_path(table)]
+        except KeyError:
+            raise exceptions.NotFound(f"Not found: Table {table_path(table)}")
+
+    def create_table(self, table):
+        self.call("create_table")
+        path = table_path(table)
+        if path in self.tables:
+            raise exceptions.Conflict(f"Already Exists: Table {path}")
+        self.tables[path] = table
+        return table
+
+    def update_table(self, table, fields):
+        self.call("update_table")
+        path = table_path(table)
+        if path not in self.tables:
+            raise exceptions.NotFound(f"Not found: Table {path}")
+        self.tables[path] = table
+        return table
+
+    def delete_table(self, table):
+        self.call("delete_table")
+        self.tables.pop(table_path(table), None)
+
+    def insert_rows_json(self, table, json_rows, row_ids=None, **kwargs):
+        self.call("insert_rows_json")
+        chance = self.random.random()
+        if chance < self.error_rate:
+            raise exceptions.InternalServerError(
+                "Injected error", errors=[{"reason": "backendError"}]
+            )
+        if chance < self.error_rate + self.row_error_rate:
+            return [{"index": 0, "errors": [{"reason": "invalid", "message": "Injected error"}]}]
+
+        with self.lock:
+            self.rows[table_path(table)].extend(json_rows)
+        return []
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, rewind=False):
+        self.call("load_table_from_file")
+        if rewind:
+            file_obj.seek(0)
+        output_rows = sum(1 for _ in file_obj)
+        self.tables.setdefault(
+            table_path(destination), bigquery.Table(destination, schema=job_config.schema)
+        )
+        return FakeLoadJob(self, output_rows)
+
+    def close(self):
+        pass
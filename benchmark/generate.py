@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Generate synthetic Singer tap output to benchmark `target-bigquery` with.
+
+    python -m benchmark.generate --streams 2 --rows 100000 --width 20 > tap.jsonl
+"""
+
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+
+import simplejson as json
+
+
+# The column types we cycle through, as `(JSON schema, value factory)`
+COLUMN_TYPES = [
+    ({"type": ["null", "string"]}, lambda rnd, i: f"value-{rnd.randint(0, 10 ** 6)}"),
+    ({"type": ["null", "integer"]}, lambda rnd, i: rnd.randint(-(2**31), 2**31)),
+    ({"type": ["null", "number"]}, lambda rnd, i: rnd.random() * 1000),
+    ({"type": ["null", "boolean"]}, lambda rnd, i: rnd.random() > 0.5),
+    (
+        {"type": ["null", "string"], "format": "date-time"},
+        lambda rnd, i: (datetime(2020, 1, 1) + timedelta(seconds=i)).isoformat() + "+00:00",
+    ),
+]
+
+
+def build_properties(width, nesting):
+    properties = {}
+    factories = {}
+    for column in range(width):
+        schema, factory = COLUMN_TYPES[column % len(COLUMN_TYPES)]
+        properties[f"column_{column}"] = schema
+        factories[f"column_{column}"] = factory
+
+    if nesting > 0:
+        nested_properties, nested_factories = build_properties(max(width // 2, 1), nesting - 1)
+        properties["nested"] = {"type": ["null", "object"], "properties": nested_properties}
+        factories["nested"] = nested_factories
+
+    return properties, factories
+
+
+def build_record(factories, rnd, i):
+    return {
+        name: build_record(factory, rnd, i) if isinstance(factory, dict) else factory(rnd, i)
+        for name, factory in factories.items()
+    }
+
+
+def state_message(tap_stream_id, replication_key_value=None):
+    bookmark = {"last_replication_method": "INCREMENTAL", "replication_key": "id", "version": 1}
+    if replication_key_value is not None:
+        bookmark["replication_key_value"] = replication_key_value
+    return {
+        "type": "STATE",
+        "value": {"bookmarks": {tap_stream_id: bookmark}, "currently_syncing": tap_stream_id},
+    }
+
+
+def generate_lines(streams=1, rows=10000, width=10, nesting=0, state_every=1000, seed=0):
+    """Yield Singer messages (as JSON lines) the same way a database tap would: a schema and an
+    initial state per stream, followed by its records with a state every `state_every` records"""
+    rnd = random.Random(seed)
+    properties, factories = build_properties(width, nesting)
+    properties = {"id": {"type": ["integer"]}, **properties}
+
+    for stream_number in range(streams):
+        stream = f"stream_{stream_number}"
+        tap_stream_id = f"benchmark-public-{stream}"
+
+        yield json.dumps(
+            {
+                "type": "SCHEMA",
+                "stream": stream,
+                "schema": {"type": "object", "properties": properties},
+                "key_properties": ["id"],
+                "bookmark_properties": ["id"],
+            }
+        )
+        yield json.dumps(state_message(tap_stream_id))
+
+        for i in range(rows):
+            record = {"id": i, **build_record(factories, rnd, i)}
+            yield json.dumps({"type": "RECORD", "stream": stream, "record": record, "version": 1})
+            if state_every and (i + 1) % state_every == 0:
+                yield json.dumps(state_message(tap_stream_id, i))
+
+        yield json.dumps(state_message(tap_stream_id, rows))
+
+
+def add_arguments(parser):
+    parser.add_argument("--streams", type=int, default=1, help="Number of streams")
+    parser.add_argument("--rows", type=int, default=10000, help="Records per stream")
+    parser.add_argument("--width", type=int, default=10, help="Top level columns per record")
+    parser.add_argument("--nesting", type=int, default=0, help="Levels of nested objects")
+    parser.add_argument(
+        "--state-every", type=int, default=1000, help="Emit a state after this many records"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    for line in generate_lines(
+        streams=args.streams,
+        rows=args.rows,
+        width=args.width,
+        nesting=args.nesting,
+        state_every=args.state_every,
+        seed=args.seed,
+    ):
+        sys.stdout.write(f"{line}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Measure how long `import target_bigquery` takes, to catch cold start regressions.
+
+    python -m benchmark.importtime --runs 5 --max-ms 300
+
+Exits with an error when the median import time is over `--max-ms`, or when any of the modules
+we only import lazily got imported at start up.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+# These are only needed once we actually talk to BigQuery (or validate records)
+LAZY_MODULES = ["google.cloud.bigquery", "google.auth", "oauth2client", "pkg_resources"]
+
+
+def import_times():
+    """Import `target_bigquery` in a fresh interpreter, returning the cumulative import time (in
+    microseconds) of every module it imported"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import target_bigquery"],
+        check=True,
+        stderr=subprocess.PIPE,
+    ).stderr.decode("utf-8")
+
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Number of imports to measure")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to show")
+    parser.add_argument("--max-ms", type=float, help="Fail if the median is slower than this")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    median_ms = statistics.median(run["target_bigquery"] for run in runs) / 1000
+
+    print(f"import target_bigquery: {median_ms:.1f} ms (median of {args.runs})")
+    last_run = runs[-1]
+    for module, cumulative in sorted(last_run.items(), key=lambda item: -item[1])[1 : args.top]:
+        print(f"  {module:<40} {cumulative / 1000:>8.1f} ms")
+
+    failures = [
+        f"'{module}' is imported at start up" for module in LAZY_MODULES if module in last_run
+    ]
+    if args.max_ms and median_ms > args.max_ms:
+        failures.append(f"import took {median_ms:.1f} ms, over the {args.max_ms} ms budget")
+
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
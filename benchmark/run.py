@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Benchmark `target-bigquery` against the fake BigQuery backend.
+
+    python -m benchmark.run --rows 50000 --width 20 --latency 0.05
+
+Each mode runs in its own process so its peak RSS can be reported.
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import resource
+import subprocess
+import sys
+from time import perf_counter
+
+import simplejson as json
+
+import target_bigquery
+from benchmark.fake_bigquery import FakeClient
+from benchmark.generate import add_arguments, generate_lines
+
+
+# Each mode is the `persist_lines_*` function to run and any extra arguments for it
+MODES = {
+    "hybrid": (target_bigquery.persist_lines_hybrid, {}),
+    "hybrid-concurrent": (target_bigquery.persist_lines_hybrid, {"max_inflight_inserts": 8}),
+    "job": (target_bigquery.persist_lines_job, {}),
+    "stream": (target_bigquery.persist_lines_stream, {}),
+}
+
+
+def run_mode(mode, args):
+    lines = list(
+        generate_lines(
+            streams=args.streams,
+            rows=args.rows,
+            width=args.width,
+            nesting=args.nesting,
+            state_every=args.state_every,
+            seed=args.seed,
+        )
+    )
+    client = FakeClient(
+        latency=args.latency, error_rate=args.error_rate, row_error_rate=args.row_error_rate
+    )
+    metrics = target_bigquery.Metrics(log_interval=float("inf"))
+
+    # We don't want to benchmark sleeping or logging
+    target_bigquery.TABLE_CREATION_PAUSE = 0
+    target_bigquery.logger.setLevel(logging.WARNING)
+
+    persist_lines, kwargs = MODES[mode]
+    start = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        persist_lines(
+            client.project,
+            "benchmark",
+            lines,
+            validate_records=args.validate_records,
+            validate_records_every=args.validate_every,
+            type_check_records=args.type_check,
+            bigquery_client=client,
+            metrics=metrics,
+            **kwargs,
+        )
+    elapsed = perf_counter() - start
+
+    return {
+        "mode": mode,
+        "rows": args.streams * args.rows,
+        "seconds": elapsed,
+        "rows_per_second": args.streams * args.rows / elapsed,
+        # NOTE: `ru_maxrss` is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "api_calls": dict(client.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument(
+        "--modes", default="hybrid,hybrid-concurrent,job", help="Comma separated modes to run"
+    )
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to each API call")
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of inserts raising retryable errors"
+    )
+    parser.add_argument(
+        "--row-error-rate", type=float, default=0, help="Fraction of inserts returning row errors"
+    )
+    parser.add_argument(
+        "--no-validate",
+        dest="validate_records",
+        action="store_false",
+        help="Don't validate records against their schema",
+    )
+    parser.add_argument(
+        "--validate-every", type=int, help="Only validate every Nth record of each stream"
+    )
+    parser.add_argument(
+        "--type-check", action="store_true", help="Check the types of top level fields"
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_mode(args.single, args)))
+        return
+
+    for mode in args.modes.split(","):
+        if mode not in MODES:
+            parser.error(f"Unknown mode '{mode}', choose from: {', '.join(MODES)}")
+
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmark.run", *sys.argv[1:], "--single", mode],
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        result = json.loads(output.decode("utf-8").splitlines()[-1])
+
+        if args.json:
+            print(json.dumps(result))
+        else:
+            calls = sorted(result["api_calls"].items())
+            calls = ", ".join(f"{name}={count}" for name, count in calls)
+            print(
+                f"{result['mode']:<18} {result['rows_per_second']:>10.0f} rows/s"
+                f" {result['peak_rss_mb']:>8.1f} MB peak RSS  {calls}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,9 @@ from string import ascii_uppercase
 from google.cloud import bigquery
 from google.auth import default as get_credentials
 
+import target_bigquery
+from benchmark.fake_bigquery import FakeClient
+
 
 @pytest.fixture(scope="function")
 def setup_bigquery_and_config():
@@ -106,3 +109,18 @@ def do_sync():
         return stdout_lines, stderr_lines
 
     return make_do_sync
+
+
+@pytest.fixture(scope="function")
+def fake_bigquery(monkeypatch):
+    monkeypatch.setattr(target_bigquery, "TABLE_CREATION_PAUSE", 0)
+
+    def make_fake_bigquery(lines, persist_lines=None, client=None, **kwargs):
+        # Runs the target in-process against an in-memory BigQuery and returns the fake client.
+        if client is None:
+            client = FakeClient()
+        persist_lines = persist_lines or target_bigquery.persist_lines_hybrid
+        persist_lines(client.project, "benchmark", lines, bigquery_client=client, **kwargs)
+        return client
+
+    return make_fake_bigquery
@@ -16,7 +16,6 @@ setup(
         "google-api-python-client>=1.6.2",
         "google-cloud>=0.34.0",
         "google-cloud-bigquery>=1.9.0",
-        "oauth2client>=4.1.3",
         "simplejson>=3.11.1",
     ],
     entry_points="""
@@ -1,36 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import io
 import sys
 import simplejson as json
 import logging
 import collections
+import contextlib
+import fnmatch
+import functools
+import glob
+import gzip
+import hashlib
+import importlib
+import itertools
+import os
 import threading
-import http.client
-import urllib
-import pkg_resources
 from decimal import Decimal
 from datetime import datetime, timedelta
-from time import sleep
+from time import sleep, monotonic, perf_counter
 
-from jsonschema import validate
 import singer
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
+from singer import metrics as singer_metrics
 
-from oauth2client import tools
-from tempfile import TemporaryFile
-
-from google import api_core
-from google.cloud import bigquery
-from google.cloud.bigquery import (
-    Dataset,
-    WriteDisposition,
-    SchemaUpdateOption,
-    SchemaField,
-    LoadJobConfig,
-)
-from google.cloud.bigquery.job import SourceFormat
-from google.api_core import exceptions
+from tempfile import NamedTemporaryFile, TemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+# NOTE: the target is often started for tiny incremental syncs, where importing the Google Cloud
+# libraries can take longer than the sync itself, so they are only imported in the functions
+# which need them. `jsonschema` is imported by `singer` anyway. Use `python -m benchmark.importtime`
+# to check start up time.
 
 logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
 logger = singer.get_logger()
@@ -54,10 +56,581 @@ RETRYABLE_ERROR_CODES = [
     "tableUnavailable",
 ]
 
+# The kinds of change `diff_schema` finds between two table schemas, from least to most severe
+SCHEMA_IDENTICAL = "identical"
+SCHEMA_ADDITIVE = "additive"
+SCHEMA_RELAXATION = "relaxation"
+SCHEMA_INCOMPATIBLE = "incompatible"
+SCHEMA_CHANGES = [SCHEMA_IDENTICAL, SCHEMA_ADDITIVE, SCHEMA_RELAXATION, SCHEMA_INCOMPATIBLE]
+
+# Column types BigQuery can partition and cluster a table by
+PARTITION_FIELD_TYPES = ["TIMESTAMP", "DATE", "DATETIME"]
+CLUSTERING_FIELD_TYPES = [
+    "STRING",
+    "INTEGER",
+    "NUMERIC",
+    "BIGNUMERIC",
+    "BOOLEAN",
+    "TIMESTAMP",
+    "DATE",
+    "DATETIME",
+    "GEOGRAPHY",
+]
+
+# BigQuery can return the standard SQL names of the (legacy SQL) types we create tables with
+FIELD_TYPE_ALIASES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD",
+}
+
+# Python types `singer.parse_message` gives us for each JSON schema type
+JSON_SCHEMA_TYPES = {
+    "null": (type(None),),
+    "boolean": (bool,),
+    "integer": (int,),
+    "number": (int, float, Decimal),
+    "string": (str,),
+    "object": (dict,),
+    "array": (list,),
+}
+
 StreamMeta = collections.namedtuple(
     "StreamMeta", ["schema", "key_properties", "bookmark_properties"]
 )
 
+# Bytes of the hash used as the insert ID of rows with long keys, it's twice as many hex digits
+ROW_ID_HASH_SIZE = 16
+
+Destination = collections.namedtuple("Destination", ["project_id", "dataset_id", "location"])
+
+
+class Metrics:
+    """Per-stream counters and timers, logged as Singer `METRIC` lines at most every
+    `log_interval` seconds and optionally rewritten to a JSON or Prometheus textfile"""
+
+    RECORD_COUNT = "record_count"
+    # Size of the RECORD messages read, in every mode
+    BYTES_RECEIVED = "bytes_received"
+    # Size of the rows written to the load job file, only in job mode
+    BYTES_STAGED = "bytes_staged"
+    BATCH_COUNT = "batch_count"
+    RETRY_COUNT = "retry_count"
+    FAILED_ROW_COUNT = "failed_row_count"
+    DEDUPLICATED_ROW_COUNT = "deduplicated_row_count"
+    INSERT_DURATION = "insert_duration"
+
+    # Upper bounds (in seconds) of the insert latency histogram buckets
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, log_interval=60, textfile=None, textfile_format="json"):
+        self.log_interval = log_interval
+        self.textfile = textfile
+        self.textfile_format = textfile_format
+        # Totals for the whole run and the part of it which hasn't been logged yet
+        self.counters = collections.defaultdict(int)
+        self.unlogged = collections.defaultdict(int)
+        # Counts made with `count` which `commit` hasn't added to the totals yet
+        self.pending = collections.defaultdict(int)
+        # Each histogram is a list of bucket counts followed by the sum and the count
+        self.histograms = {}
+        self.lock = threading.Lock()
+        # Held while writing the textfile so an older snapshot never replaces a newer one
+        self.textfile_lock = threading.Lock()
+        self.last_logged = monotonic()
+
+    def increment(self, stream, metric, value=1):
+        self.add({(stream, metric): value})
+
+    def count(self, stream, metric, value=1):
+        """Like `increment`, without taking the lock for each record. Only for the main thread,
+        the counts are added to the totals by `commit`."""
+        self.pending[(stream, metric)] += value
+
+    def commit(self):
+        """Add the counts made with `count` to the totals, on the main thread"""
+        pending, self.pending = self.pending, collections.defaultdict(int)
+        if pending:
+            self.add(pending)
+
+    def add(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.counters[key] += value
+                self.unlogged[key] += value
+            # Inserts increment metrics from several threads, only one of them should log
+            should_log = monotonic() - self.last_logged > self.log_interval
+            if should_log:
+                self.last_logged = monotonic()
+        if should_log:
+            self.log()
+
+    def observe(self, stream, metric, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                (stream, metric), [0] * (len(self.LATENCY_BUCKETS) + 2)
+            )
+            for i, bucket in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        singer_metrics.log(
+            logger, singer_metrics.Point("timer", metric, seconds, {"stream": stream})
+        )
+
+    @contextlib.contextmanager
+    def timer(self, stream, metric):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stream, metric, monotonic() - start)
+
+    def log(self):
+        with self.lock:
+            unlogged = self.unlogged
+            self.unlogged = collections.defaultdict(int)
+            self.last_logged = monotonic()
+
+        for (stream, metric), value in unlogged.items():
+            singer_metrics.log(
+                logger, singer_metrics.Point("counter", metric, value, {"stream": stream})
+            )
+
+        if self.textfile:
+            self.write_textfile()
+
+    def write_textfile(self):
+        with self.textfile_lock:
+            with self.lock:
+                counters = dict(self.counters)
+                histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+
+            if self.textfile_format == "prometheus":
+                lines = []
+                for (stream, metric), value in sorted(counters.items()):
+                    lines.append(f'target_bigquery_{metric}{{stream="{stream}"}} {value}')
+                for (stream, metric), histogram in sorted(histograms.items()):
+                    name = f"target_bigquery_{metric}_seconds"
+                    for bucket, count in zip(self.LATENCY_BUCKETS, histogram):
+                        lines.append(f'{name}_bucket{{stream="{stream}",le="{bucket}"}} {count}')
+                    lines.append(f'{name}_bucket{{stream="{stream}",le="+Inf"}} {histogram[-1]}')
+                    lines.append(f'{name}_sum{{stream="{stream}"}} {histogram[-2]}')
+                    lines.append(f'{name}_count{{stream="{stream}"}} {histogram[-1]}')
+                content = "\n".join(lines) + "\n"
+            else:
+                streams = collections.defaultdict(dict)
+                for (stream, metric), value in counters.items():
+                    streams[stream][metric] = value
+                for (stream, metric), histogram in histograms.items():
+                    streams[stream][metric] = {
+                        "buckets": dict(zip(map(str, self.LATENCY_BUCKETS), histogram)),
+                        "sum": histogram[-2],
+                        "count": histogram[-1],
+                    }
+                content = json.dumps({"streams": streams})
+
+            # Write to a temporary file first so readers never see a half written file
+            with NamedTemporaryFile(
+                "w",
+                dir=os.path.dirname(os.path.abspath(self.textfile)),
+                prefix=f"{os.path.basename(self.textfile)}.",
+                suffix=".tmp",
+                delete=False,
+            ) as f:
+                f.write(content)
+            os.replace(f.name, self.textfile)
+
+
+class ProfilerStage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, perf_counter() - self.start)
+
+
+class Profiler:
+    """Cumulative time spent in each pipeline stage (parse, validate, transform, serialize,
+    insert, network, sleep), optionally with cProfile stats and periodic tracemalloc snapshots,
+    written to `report_file` when the process exits. Does nothing until `start` is called.
+
+    `insert_rows_json` serialises rows itself, so its calls are an `insert` stage which includes
+    serialising them as well as the request."""
+
+    def __init__(self):
+        self.enabled = False
+        self.report_file = None
+        self.stages = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.cprofile = None
+        self.snapshots = []
+        self.stop_snapshots = threading.Event()
+        self.started = None
+
+    def start(self, report_file, use_cprofile=False, tracemalloc_interval=None):
+        self.enabled = True
+        self.report_file = report_file
+        self.started = perf_counter()
+
+        if use_cprofile:
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+        if tracemalloc_interval:
+            import tracemalloc
+
+            tracemalloc.start()
+            threading.Thread(
+                target=self.take_snapshots, args=(tracemalloc_interval,), daemon=True
+            ).start()
+
+        atexit.register(self.write_report)
+
+    def stage(self, name):
+        return ProfilerStage(self, name) if self.enabled else contextlib.nullcontext()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.stages[name] += seconds
+            self.calls[name] += 1
+
+    def take_snapshots(self, interval):
+        while not self.stop_snapshots.wait(interval):
+            self.snapshot()
+
+    def snapshot(self):
+        import tracemalloc
+
+        top_allocations = tracemalloc.take_snapshot().statistics("lineno")[:10]
+        with self.lock:
+            self.snapshots.append(
+                (perf_counter() - self.started, [str(stat) for stat in top_allocations])
+            )
+
+    def write_report(self):
+        import tracemalloc
+
+        self.stop_snapshots.set()
+        if tracemalloc.is_tracing():
+            self.snapshot()
+            tracemalloc.stop()
+
+        with open(self.report_file, "w") as f:
+            f.write(f"Total run time: {perf_counter() - self.started:.3f}s\n\n")
+            # NOTE: inserts can run on several threads, so stages can add up to more than the total
+            f.write("Cumulative time per stage:\n")
+            for name, seconds in sorted(self.stages.items(), key=lambda item: -item[1]):
+                f.write(f"  {name:<10} {seconds:>12.3f}s {self.calls[name]:>12} call(s)\n")
+
+            for elapsed, top_allocations in self.snapshots:
+                f.write(f"\nTop allocations after {elapsed:.1f}s:\n")
+                for line in top_allocations:
+                    f.write(f"  {line}\n")
+
+            if self.cprofile:
+                import pstats
+
+                self.cprofile.disable()
+                self.cprofile.dump_stats(f"{self.report_file}.prof")
+                f.write("\n")
+                pstats.Stats(self.cprofile, stream=f).sort_stats("cumulative").print_stats(50)
+
+
+profiler = Profiler()
+
+
+def pause(seconds):
+    with profiler.stage("sleep"):
+        sleep(seconds)
+
+
+class WriteAheadLog:
+    """Append-only log of the messages accepted by the HYBRID sync method, so rows which were
+    buffered when the target died can be replayed instead of extracted again by the tap.
+
+    The log is split into segments at every state, each one starting with the latest schema of
+    every stream so it can be replayed on its own. A segment is deleted once all of its rows are
+    written to BigQuery, and every segment when the target finishes normally."""
+
+    def __init__(self, directory, fsync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        # Segments left over by a previous run which didn't finish
+        self.replay_segments = sorted(glob.glob(os.path.join(directory, "*.wal")))
+        self.sequence = (
+            int(os.path.basename(self.replay_segments[-1])[: -len(".wal")]) + 1
+            if self.replay_segments
+            else 0
+        )
+        # The latest SCHEMA message of each stream
+        self.schemas = {}
+        # The streams with rows which aren't written yet in each segment, oldest first
+        self.segments = collections.OrderedDict()
+        self.file = None
+        self.open_segment()
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:012d}.wal")
+
+    def open_segment(self):
+        self.current = self.sequence
+        self.sequence += 1
+        self.file = open(self.segment_path(self.current), "w", encoding="utf-8")
+        self.segments[self.current] = set()
+        for line in self.schemas.values():
+            self.write(line)
+
+    def write(self, line):
+        self.file.write(line if line.endswith("\n") else f"{line}\n")
+        # Flush every line, we only want to survive the process dying (not the machine) unless
+        # `fsync` is set
+        self.file.flush()
+
+    def replay(self):
+        """Yield the lines of segments left over by a previous run. As the lines are logged again
+        while they're processed, each segment is deleted once it's been read."""
+        for path in self.replay_segments:
+            logger.info(f"Replaying write-ahead log segment: {path}")
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    # The last line can be incomplete if we died while writing it
+                    if line.endswith("\n"):
+                        yield line
+            os.remove(path)
+        self.replay_segments = []
+
+    def append_schema(self, stream, line):
+        self.schemas[stream] = line
+        self.write(line)
+
+    def append_record(self, stream, line):
+        self.write(line)
+        self.segments[self.current].add(stream)
+
+    def append_state(self, line):
+        """Close the current segment with the state and start a new one"""
+        self.write(line)
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.open_segment()
+
+    def acknowledge(self, stream, before):
+        """Mark the rows of `stream` in the segments before `before` as written and delete the
+        segments which don't have any unwritten rows left"""
+        for sequence, streams in self.segments.items():
+            if sequence >= before:
+                break
+            streams.discard(stream)
+
+        # Segments are deleted in order, so we always replay everything after the oldest one
+        while len(self.segments) > 1:
+            sequence, streams = next(iter(self.segments.items()))
+            if streams:
+                break
+            os.remove(self.segment_path(sequence))
+            del self.segments[sequence]
+
+    def close(self):
+        self.file.close()
+        for sequence in self.segments:
+            os.remove(self.segment_path(sequence))
+        self.segments.clear()
+
+
+def build_bigquery_client(
+    project_id,
+    location=None,
+    pool_size=10,
+    keepalive=True,
+    request_timeout=None,
+    upload_chunk_size=None,
+):
+    import socket
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import bigquery
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+
+    credentials, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+
+    if request_timeout is not None:
+        # Apply the timeout to every request the library doesn't pass one for
+        session_request = session.request
+
+        def request_with_timeout(method, url, *args, **kwargs):
+            if kwargs.get("timeout") is None:
+                kwargs["timeout"] = request_timeout
+            return session_request(method, url, *args, **kwargs)
+
+        session.request = request_with_timeout
+
+    # By default `requests` only keeps 10 connections per host around, which makes concurrent
+    # inserts wait for each other to check out a connection
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    if keepalive:
+        # TCP keep-alive stops proxies or NAT dropping idle connections between flushes, so we
+        # don't pay for a new TLS handshake each time
+        adapter.init_poolmanager(
+            pool_size,
+            pool_size,
+            socket_options=HTTPConnection.default_socket_options
+            + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)],
+        )
+    session.mount("https://", adapter)
+
+    if upload_chunk_size:
+        # NOTE: `load_table_from_file` doesn't let us pass the chunk size for resumable uploads,
+        # so we have to override the module default. It has to be a multiple of 256 KB, see:
+        # https://cloud.google.com/bigquery/docs/reference/api-uploads#resumable
+        bigquery.client._DEFAULT_CHUNKSIZE = upload_chunk_size
+
+    return bigquery.Client(
+        project=project_id, credentials=credentials, _http=session, location=location
+    )
+
+
+class ClientPool:
+    """BigQuery clients made by `factory(project_id, location=...)`, one for each project and
+    location so every stream going there shares it, which create each destination's dataset the
+    first time it's used"""
+
+    def __init__(self, factory=build_bigquery_client, **kwargs):
+        self.factory = factory
+        self.kwargs = kwargs
+        self.clients = {}
+        self.datasets = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def of_client(cls, bigquery_client):
+        """A pool sending every destination through `bigquery_client`"""
+        return cls(lambda project_id, location=None: bigquery_client)
+
+    def get(self, project_id, location=None):
+        with self.lock:
+            key = (project_id, location)
+            if key not in self.clients:
+                self.clients[key] = self.factory(project_id, location=location, **self.kwargs)
+            return self.clients[key]
+
+    def get_for(self, destination, create_dataset=True):
+        """Return the client for `destination`, creating its dataset if we haven't yet unless
+        `create_dataset` is False"""
+        from google.cloud import bigquery
+
+        bigquery_client = self.get(destination.project_id, destination.location)
+        if create_dataset and destination not in self.datasets:
+            dataset = bigquery.Dataset(f"{destination.project_id}.{destination.dataset_id}")
+            if destination.location:
+                dataset.location = destination.location
+            bigquery_client.create_dataset(dataset, exists_ok=True)
+            self.datasets.add(destination)
+        return bigquery_client
+
+    def close(self):
+        for bigquery_client in self.clients.values():
+            bigquery_client.close()
+        self.clients.clear()
+
+
+def build_stream_router(project_id, dataset_id, location=None, destinations=None):
+    """Return a function mapping a stream to its `Destination`, from the first of `destinations`
+    whose `streams` (a pattern or a list of patterns and stream names) match it. Streams which
+    don't match any go to `project_id.dataset_id`, as do destinations without their own."""
+    default = Destination(project_id, dataset_id, location)
+    routes = []
+    for destination in destinations or []:
+        patterns = destination["streams"]
+        routes.append(
+            (
+                [patterns] if isinstance(patterns, str) else patterns,
+                Destination(
+                    destination.get("project_id", project_id),
+                    destination.get("dataset_id", dataset_id),
+                    destination.get("location", location),
+                ),
+            )
+        )
+
+    @functools.lru_cache(maxsize=None)
+    def route(stream):
+        for patterns, destination in routes:
+            if any(fnmatch.fnmatchcase(stream, pattern) for pattern in patterns):
+                return destination
+        return default
+
+    return route
+
+
+def get_client_pool(client_pool=None, bigquery_client=None, **kwargs):
+    """Return the client pool to use and whether it's ours to close"""
+    if client_pool is not None:
+        return client_pool, False
+    if bigquery_client is not None:
+        return ClientPool.of_client(bigquery_client), False
+    return ClientPool(**kwargs), True
+
+
+def capture_lines(lines, capture_file):
+    """Pass `lines` through, writing each of them with the time (since the start) the target read
+    it to the gzipped `capture_file`, so the run can be replayed later with `replay_lines`.
+
+    As the tap blocks while the target is busy, these times include the target's own pauses and
+    inserts, not only the tap's pace."""
+    start = monotonic()
+    with gzip.open(capture_file, "wt", encoding="utf-8") as f:
+        for line in lines:
+            captured_line = line if line.endswith("\n") else f"{line}\n"
+            f.write(f"{monotonic() - start:.6f}\t{captured_line}")
+            yield line
+
+
+def replay_lines(capture_file, pace="max"):
+    """Yield the lines of a file written by `capture_lines`, either as fast as possible (`"max"`)
+    or at the pace they were originally read (`"original"`). A capture cut off by a crash is
+    replayed up to where it ends."""
+    start = monotonic()
+    with gzip.open(capture_file, "rt", encoding="utf-8") as f:
+        try:
+            for captured_line in f:
+                # The last line can be incomplete if the capture was cut off
+                if not captured_line.endswith("\n"):
+                    break
+                elapsed, line = captured_line.split("\t", 1)
+                if pace == "original":
+                    # NOTE: not `pause`, the replayed run shouldn't count this as its own sleep
+                    sleep(max(float(elapsed) - (monotonic() - start), 0))
+                yield line
+        except EOFError:
+            logger.warning(f"Capture file was cut off, replayed up to its end: {capture_file}")
+
+
+def load_client_factory(path):
+    """Import a client factory from a `"module:callable"` path, ie to run against a fake backend"""
+    module_name, _, name = path.partition(":")
+    return getattr(importlib.import_module(module_name), name)
+
+
+def message_size(line):
+    """Size in bytes of a message read as `str`, without encoding it again if it's ASCII"""
+    if isinstance(line, bytes) or line.isascii():
+        return len(line)
+    return len(line.encode("utf-8"))
+
 
 def emit_state(state):
     if state is not None:
@@ -67,10 +640,134 @@ def emit_state(state):
         sys.stdout.flush()
 
 
+class StateEmitter:
+    """Emits committed states, holding them back until at least `min_interval` seconds and
+    `every` states have passed since the last one emitted. Only the latest state held back is
+    kept, `flush` emits it."""
+
+    def __init__(self, min_interval=0, every=1):
+        self.min_interval = min_interval
+        self.every = every
+        self.pending = None
+        self.pending_count = 0
+        self.last_emitted = float("-inf")
+
+    def emit(self, state):
+        if state is None:
+            return
+        self.pending = state
+        self.pending_count += 1
+        if (
+            self.pending_count >= self.every
+            and monotonic() - self.last_emitted >= self.min_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.pending is not None:
+            emit_state(self.pending)
+            self.last_emitted = monotonic()
+        self.pending = None
+        self.pending_count = 0
+
+
 def clear_dict_hook(items):
     return {k: v if v is not None else "" for k, v in items}
 
 
+def build_row_id_extractor(key_properties):
+    """Return a function computing the insert ID of a record from its key properties (hashed when
+    they're long), or None for streams without any (and records missing one) so BigQuery doesn't
+    deduplicate their rows"""
+    if not key_properties:
+        return lambda record: None
+
+    key_properties = tuple(key_properties)
+
+    def row_id(record):
+        # The repr of the values keeps keys like ("a-b", "c") and ("a", "b-c") apart, and it's
+        # much cheaper than serialising them as JSON. Long ones are hashed to fit in an insert ID,
+        # which can't clash with short ones as those start with "("
+        try:
+            key = repr(tuple([record[val] for val in key_properties]))
+        except KeyError:
+            # Records missing a key property would all get the same ID and be deduplicated
+            return None
+        if len(key) <= ROW_ID_HASH_SIZE * 2:
+            return key
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=ROW_ID_HASH_SIZE).hexdigest()
+
+    return row_id
+
+
+def build_type_checker(schema):
+    """Return a function checking the types of a record's top level fields against `schema`,
+    which catches most bad data for a small fraction of the cost of full validation"""
+    field_types = {}
+    for name, field in schema.get("properties", {}).items():
+        types = field.get("type")
+        types = [types] if isinstance(types, str) else types or []
+        # Fields without a type (ie `anyOf`) are left to full validation
+        if types and all(type_name in JSON_SCHEMA_TYPES for type_name in types):
+            field_types[name] = (
+                tuple(itertools.chain.from_iterable(JSON_SCHEMA_TYPES[t] for t in types)),
+                types,
+            )
+
+    def check_types(record):
+        for name, value in record.items():
+            if name not in field_types:
+                continue
+            python_types, types = field_types[name]
+            # NOTE: `bool` is a subclass of `int`, so it would pass as an integer or a number
+            if not isinstance(value, python_types) or (
+                type(value) is bool and "boolean" not in types
+            ):
+                raise ValidationError(f"{value!r} is not of type {types} for field '{name}'")
+
+    return check_types
+
+
+def build_record_validator(
+    schema,
+    validate_records=True,
+    validate_records_every=None,
+    validate_records_first=None,
+    type_check_records=False,
+):
+    """Return a function checking records of a stream against its `schema`, or None if there's
+    nothing to check.
+
+    With `validate_records` every record is validated unless `validate_records_every` or
+    `validate_records_first` are set, in which case only every Nth record and/or the first N
+    records are. `type_check_records` checks the type of top level fields of every record."""
+    type_checker = build_type_checker(schema) if type_check_records else None
+    validator = None
+    if validate_records:
+        # `jsonschema.validate` checks the schema itself on every call, we only need to once
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+    if not type_checker and not validator:
+        return None
+
+    record_count = itertools.count()
+
+    def validate_record(record):
+        if type_checker:
+            type_checker(record)
+        if validator:
+            index = next(record_count)
+            if (
+                not (validate_records_every or validate_records_first)
+                or (validate_records_every and index % validate_records_every == 0)
+                or (validate_records_first and index < validate_records_first)
+            ):
+                validator.validate(record)
+
+    return validate_record
+
+
 def define_schema(field, name, ignore_required=False):
     schema_name = name
     schema_type = "STRING"
@@ -116,6 +813,8 @@ def define_schema(field, name, ignore_required=False):
 
 
 def build_schema(schema, ignore_required=False):
+    from google.cloud.bigquery import SchemaField
+
     bigquery_schema = []
     for key in schema["properties"].keys():
         if not (bool(schema["properties"][key])):
@@ -131,16 +830,172 @@ def build_schema(schema, ignore_required=False):
     return bigquery_schema
 
 
-def persist_lines_job(project_id, dataset_id, lines=None, truncate=False, validate_records=True):
+def normalise_field_type(field_type):
+    field_type = field_type.upper()
+    return FIELD_TYPE_ALIASES.get(field_type, field_type)
+
+
+def diff_schema(current, target):
+    """Compare a table's `current` schema with the `target` one, returning which kind of change
+    (one of the `SCHEMA_*` constants) is needed and the smallest schema to update the table to.
+
+    Fields are matched by name so their order doesn't matter. Fields missing from `target` are
+    kept, REQUIRED ones relaxed to NULLABLE, and new fields are added at the end. For an
+    incompatible change the `target` schema is returned as it is."""
+    from google.cloud.bigquery import SchemaField
+
+    target_fields = {field.name: field for field in target}
+    change = SCHEMA_IDENTICAL
+    new_schema = []
+
+    for field in current:
+        target_field = target_fields.pop(field.name, None)
+        field_type = normalise_field_type(field.field_type)
+        mode = field.mode
+        subfields = field.fields
+        field_change = SCHEMA_IDENTICAL
+
+        if target_field is None:
+            # Rows won't have this column anymore, which is fine unless it's REQUIRED
+            if mode == "REQUIRED":
+                field_change, mode = SCHEMA_RELAXATION, "NULLABLE"
+        elif field_type != normalise_field_type(target_field.field_type):
+            return SCHEMA_INCOMPATIBLE, target
+        elif (mode == "REPEATED") != (target_field.mode == "REPEATED"):
+            return SCHEMA_INCOMPATIBLE, target
+        else:
+            if mode == "REQUIRED" and target_field.mode != "REQUIRED":
+                field_change, mode = SCHEMA_RELAXATION, "NULLABLE"
+            if field_type == "RECORD":
+                subfield_change, subfields = diff_schema(field.fields, target_field.fields)
+                if subfield_change == SCHEMA_INCOMPATIBLE:
+                    return SCHEMA_INCOMPATIBLE, target
+                field_change = max(field_change, subfield_change, key=SCHEMA_CHANGES.index)
+
+        if field_change == SCHEMA_IDENTICAL:
+            # Keep the field as it is so we don't lose anything we don't know about (ie policy tags)
+            new_schema.append(field)
+        else:
+            new_schema.append(
+                SchemaField(
+                    field.name,
+                    field.field_type,
+                    mode=mode,
+                    description=field.description,
+                    fields=tuple(subfields),
+                )
+            )
+            change = max(change, field_change, key=SCHEMA_CHANGES.index)
+
+    for field in target_fields.values():
+        # BigQuery only allows adding NULLABLE or REPEATED columns to an existing table
+        if field.mode == "REQUIRED":
+            field = SchemaField(
+                field.name, field.field_type, description=field.description, fields=field.fields
+            )
+        new_schema.append(field)
+        change = max(change, SCHEMA_ADDITIVE, key=SCHEMA_CHANGES.index)
+
+    return change, new_schema
+
+
+def get_table_options(table_options, stream):
+    """Return the `table_options` config of `stream`, falling back to the `"*"` options"""
+    table_options = table_options or {}
+    return table_options.get(stream, table_options.get("*"))
+
+
+def apply_table_options(
+    target, table_options, stream, schema, key_properties=None, bookmark_properties=None
+):
+    """Set up time partitioning and clustering on `target` (a `Table` or `LoadJobConfig`) from the
+    `table_options` config of `stream`, falling back to the `"*"` options for every stream.
+
+    Unless they are set explicitly the partitioning field is the first bookmark property if it's a
+    TIMESTAMP, DATE or DATETIME column (otherwise tables are partitioned by ingestion time), and
+    the clustering fields are the key properties BigQuery can cluster on."""
+    from google.cloud.bigquery import TimePartitioning
+
+    options = get_table_options(table_options, stream)
+    # NOTE: an empty entry still means the default partitioning and clustering
+    if options is None:
+        return target
+
+    fields = {field.name: field for field in schema}
+
+    if "partition_field" in options:
+        partition_field = options["partition_field"]
+    else:
+        partition_field = next(
+            (
+                name
+                for name in (bookmark_properties or [])[:1]
+                if name in fields
+                and normalise_field_type(fields[name].field_type) in PARTITION_FIELD_TYPES
+                and fields[name].mode != "REPEATED"
+            ),
+            None,
+        )
+
+    expiration_days = options.get("partition_expiration_days")
+    target.time_partitioning = TimePartitioning(
+        type_=options.get("partition_type", "DAY"),
+        field=partition_field,
+        # NOTE: the API only accepts a whole number of milliseconds
+        expiration_ms=int(expiration_days * 24 * 60 * 60 * 1000) if expiration_days else None,
+    )
+
+    if "clustering_fields" in options:
+        clustering_fields = options["clustering_fields"]
+    else:
+        clustering_fields = [
+            name
+            for name in key_properties or []
+            if name in fields
+            and normalise_field_type(fields[name].field_type) in CLUSTERING_FIELD_TYPES
+            and fields[name].mode != "REPEATED"
+        ]
+    # NOTE: BigQuery only allows up to 4 clustering fields
+    target.clustering_fields = clustering_fields[:4] or None
+
+    return target
+
+
+def persist_lines_job(
+    project_id,
+    dataset_id,
+    lines=None,
+    truncate=False,
+    validate_records=True,
+    validate_records_every=None,
+    validate_records_first=None,
+    type_check_records=False,
+    location=None,
+    bigquery_client=None,
+    client_pool=None,
+    destinations=None,
+    metrics=None,
+    table_options=None,
+):
+    from google.api_core import exceptions
+    from google.cloud.bigquery import LoadJobConfig, SchemaUpdateOption, WriteDisposition
+    from google.cloud.bigquery.job import SourceFormat
+
     state = None
     schemas = {}
+    validators = {}
+    key_properties = {}
+    bookmark_properties = {}
     rows = {}
 
-    bigquery_client = bigquery.Client(project=project_id)
+    client_pool, owns_client_pool = get_client_pool(client_pool, bigquery_client)
+    route = build_stream_router(project_id, dataset_id, location, destinations)
+    metrics = metrics or Metrics()
 
     for line in lines:
         try:
-            msg = singer.parse_message(line)
+            with profiler.stage("parse"):
+                msg = singer.parse_message(line)
         except json.decoder.JSONDecodeError:
             logger.error("Unable to parse:\n{}".format(line))
             raise
@@ -153,13 +1008,17 @@ def persist_lines_job(project_id, dataset_id, lines=None, truncate=False, valida
                     )
                 )
 
-            schema = schemas[msg.stream]
-
-            if validate_records:
-                validate(msg.record, schema)
+            if validators[msg.stream]:
+                with profiler.stage("validate"):
+                    validators[msg.stream](msg.record)
 
             # NEWLINE_DELIMITED_JSON expects JSON string data, with a newline splitting each row.
-            rows[msg.stream].write(bytes(json.dumps(msg.record) + "\n", "UTF-8"))
+            with profiler.stage("serialize"):
+                data = bytes(json.dumps(msg.record) + "\n", "UTF-8")
+            rows[msg.stream].write(data)
+            metrics.count(msg.stream, Metrics.RECORD_COUNT)
+            metrics.count(msg.stream, Metrics.BYTES_RECEIVED, message_size(line))
+            metrics.count(msg.stream, Metrics.BYTES_STAGED, len(data))
 
             state = None
 
@@ -170,6 +1029,15 @@ def persist_lines_job(project_id, dataset_id, lines=None, truncate=False, valida
         elif isinstance(msg, singer.SchemaMessage):
             table = msg.stream
             schemas[table] = msg.schema
+            validators[table] = build_record_validator(
+                msg.schema,
+                validate_records=validate_records,
+                validate_records_every=validate_records_every,
+                validate_records_first=validate_records_first,
+                type_check_records=type_check_records,
+            )
+            key_properties[table] = msg.key_properties
+            bookmark_properties[table] = msg.bookmark_properties
             rows[table] = TemporaryFile(mode="w+b")
 
         elif isinstance(msg, singer.ActivateVersionMessage):
@@ -179,59 +1047,107 @@ def persist_lines_job(project_id, dataset_id, lines=None, truncate=False, valida
         else:
             raise Exception("Unrecognized message {}".format(msg))
 
+    metrics.commit()
+
     for table in rows.keys():
-        table_ref = bigquery_client.dataset(dataset_id).table(table)
+        destination = route(table)
+        # NOTE: load jobs never created datasets, so they don't need `bigquery.datasets.create`
+        bigquery_client = client_pool.get_for(destination, create_dataset=False)
+        table_ref = f"{destination.project_id}.{destination.dataset_id}.{table}"
         SCHEMA = build_schema(schemas[table])
 
         load_config = LoadJobConfig()
         load_config.schema = SCHEMA
         load_config.source_format = SourceFormat.NEWLINE_DELIMITED_JSON
+        if get_table_options(table_options, table) is not None:
+            # Loading into an existing table with a different partitioning or clustering fails, so
+            # they can only be set when the load job creates the table
+            try:
+                with profiler.stage("network"):
+                    bigquery_client.get_table(table_ref)
+            except exceptions.NotFound:
+                apply_table_options(
+                    load_config,
+                    table_options,
+                    table,
+                    SCHEMA,
+                    key_properties=key_properties[table],
+                    bookmark_properties=bookmark_properties[table],
+                )
 
         if truncate:
             load_config.write_disposition = WriteDisposition.WRITE_TRUNCATE
         else:
             load_config.schema_update_options = [SchemaUpdateOption.ALLOW_FIELD_ADDITION]
 
-        load_job = bigquery_client.load_table_from_file(
-            rows[table], table_ref, job_config=load_config, rewind=True
-        )
+        with profiler.stage("network"):
+            load_job = bigquery_client.load_table_from_file(
+                rows[table], table_ref, job_config=load_config, rewind=True
+            )
         logger.info(
             f"Loading '{table}' to BigQuery as job '{load_job.job_id}'", extra={"stream": table}
         )
 
+        metrics.increment(table, Metrics.BATCH_COUNT)
+
         try:
-            load_job.result()
+            with metrics.timer(table, Metrics.INSERT_DURATION), profiler.stage("network"):
+                load_job.result()
         except Exception as e:
             logger.error(
                 f"Error on inserting to table '{table}': {str(e)}", extra={"stream": table}
             )
+            metrics.log()
+            if owns_client_pool:
+                client_pool.close()
             return
 
-        logger.info(f"Loaded {load_job.output_rows} row(s) to '{table}'", extra={"stream": table})
+        logger.info(
+            f"Loaded {load_job.output_rows} row(s) to '{table_ref}'", extra={"stream": table}
+        )
+
+    metrics.log()
+    if owns_client_pool:
+        client_pool.close()
 
     return state
 
 
-def persist_lines_stream(project_id, dataset_id, lines=None, validate_records=True):
+def persist_lines_stream(
+    project_id,
+    dataset_id,
+    lines=None,
+    validate_records=True,
+    validate_records_every=None,
+    validate_records_first=None,
+    type_check_records=False,
+    location=None,
+    bigquery_client=None,
+    client_pool=None,
+    destinations=None,
+    metrics=None,
+    table_options=None,
+):
+    from google.api_core import exceptions
+    from google.cloud import bigquery
+
     state = None
     schemas = {}
+    validators = {}
     key_properties = {}
     tables = {}
+    clients = {}
     rows = {}
     errors = {}
 
-    bigquery_client = bigquery.Client(project=project_id)
-
-    dataset_ref = bigquery_client.dataset(dataset_id)
-    dataset = Dataset(dataset_ref)
-    try:
-        dataset = bigquery_client.create_dataset(Dataset(dataset_ref)) or Dataset(dataset_ref)
-    except exceptions.Conflict:
-        pass
+    client_pool, owns_client_pool = get_client_pool(client_pool, bigquery_client)
+    route = build_stream_router(project_id, dataset_id, location, destinations)
+    metrics = metrics or Metrics()
 
     for line in lines:
         try:
-            msg = singer.parse_message(line)
+            with profiler.stage("parse"):
+                msg = singer.parse_message(line)
         except json.decoder.JSONDecodeError:
             logger.error("Unable to parse:\n{}".format(line))
             raise
@@ -244,33 +1160,58 @@ def persist_lines_stream(project_id, dataset_id, lines=None, validate_records=Tr
                     )
                 )
 
-            schema = schemas[msg.stream]
-
-            if validate_records:
-                validate(msg.record, schema)
+            if validators[msg.stream]:
+                with profiler.stage("validate"):
+                    validators[msg.stream](msg.record)
 
-            errors[msg.stream] = bigquery_client.insert_rows_json(tables[msg.stream], [msg.record])
+            with profiler.stage("insert"):
+                errors[msg.stream] = clients[msg.stream].insert_rows_json(
+                    tables[msg.stream], [msg.record]
+                )
             rows[msg.stream] += 1
+            metrics.count(msg.stream, Metrics.RECORD_COUNT)
+            metrics.count(msg.stream, Metrics.BYTES_RECEIVED, message_size(line))
+            metrics.count(msg.stream, Metrics.BATCH_COUNT)
+            if errors[msg.stream]:
+                metrics.count(msg.stream, Metrics.FAILED_ROW_COUNT)
 
             state = None
 
         elif isinstance(msg, singer.StateMessage):
+            metrics.commit()
             logger.debug("Setting state to {}".format(msg.value))
             state = msg.value
 
         elif isinstance(msg, singer.SchemaMessage):
             table = msg.stream
             schemas[table] = msg.schema
+            validators[table] = build_record_validator(
+                msg.schema,
+                validate_records=validate_records,
+                validate_records_every=validate_records_every,
+                validate_records_first=validate_records_first,
+                type_check_records=type_check_records,
+            )
             key_properties[table] = msg.key_properties
-            tables[table] = bigquery.Table(
-                dataset.table(table), schema=build_schema(schemas[table])
+            destination = route(table)
+            clients[table] = client_pool.get_for(destination)
+            schema = build_schema(schemas[table])
+            tables[table] = apply_table_options(
+                bigquery.Table(
+                    f"{destination.project_id}.{destination.dataset_id}.{table}", schema=schema
+                ),
+                table_options,
+                table,
+                schema,
+                key_properties=msg.key_properties,
+                bookmark_properties=msg.bookmark_properties,
             )
             rows[table] = 0
             errors[table] = None
             try:
-                tables[table] = bigquery_client.create_table(tables[table])
+                tables[table] = clients[table].create_table(tables[table])
                 logger.info(f"Sleeping for {TABLE_CREATION_PAUSE} after creating a new table")
-                sleep(TABLE_CREATION_PAUSE)
+                pause(TABLE_CREATION_PAUSE)
             except exceptions.Conflict:
                 pass
 
@@ -285,259 +1226,429 @@ def persist_lines_stream(project_id, dataset_id, lines=None, validate_records=Tr
         if not errors[table]:
             logger.info(
                 "Loaded {} row(s) into {}:{}".format(
-                    rows[table], dataset_id, table, tables[table].path
+                    rows[table], route(table).dataset_id, table, tables[table].path
                 )
             )
         else:
             logger.error("Errors:", errors[table], sep=" ")
 
+    metrics.commit()
+    metrics.log()
+    if owns_client_pool:
+        client_pool.close()
+
     return state
 
 
 def persist_lines_hybrid(
-    project_id, dataset_id, lines=None, validate_records=True, location=None, can_delete_table=False
+    project_id,
+    dataset_id,
+    lines=None,
+    validate_records=True,
+    validate_records_every=None,
+    validate_records_first=None,
+    type_check_records=False,
+    location=None,
+    can_delete_table=False,
+    max_inflight_inserts=1,
+    deduplicate_records=False,
+    write_ahead_log_dir=None,
+    write_ahead_log_fsync=False,
+    bigquery_client=None,
+    client_pool=None,
+    destinations=None,
+    state_emitter=None,
+    metrics=None,
+    table_options=None,
 ):
+    from google import api_core
+    from google.cloud import bigquery
+
     state = None
     schemas = {}
+    validators = {}
     key_properties = {}
+    bookmark_properties = {}
+    # Streams can go to different projects and datasets, so each has its own client and table
+    clients = {}
+    table_refs = {}
     tables = {}
     updated_tables = {}
     rows = {}
-    errors = {}
+    # By using `insert_rows_json` and passing `row_ids` we avoid duplication, we work them out as
+    # rows come in so we don't need another pass over them when writing
+    row_id_extractors = {}
+    row_ids = {}
+    # Position of each row ID in `rows`, so we can replace earlier versions of a row in the batch
+    row_positions = {}
     failed_lines = []
+    write_ahead_log = (
+        WriteAheadLog(write_ahead_log_dir, fsync=write_ahead_log_fsync)
+        if write_ahead_log_dir
+        else None
+    )
+    # Each item is `(stream, table, rows, state_to_emit, log_segment, future)`, oldest first
+    pending_inserts = collections.deque()
+    insert_executor = (
+        ThreadPoolExecutor(max_workers=max_inflight_inserts) if max_inflight_inserts > 1 else None
+    )
+
+    # Only close the clients at the end if we created them here
+    client_pool, owns_client_pool = get_client_pool(
+        client_pool, bigquery_client, pool_size=max(10, max_inflight_inserts)
+    )
+    route = build_stream_router(project_id, dataset_id, location, destinations)
+    state_emitter = state_emitter or StateEmitter()
+    metrics = metrics or Metrics()
+
+    def insert_rows(stream, table, fixed_rows, ids, table_updated):
+        # NOTE: as it turns out it takes BigQuery ~2 minutes to empty cache and acknowledge
+        # a new table schema, see: https://stackoverflow.com/a/25292028/21217
+        # So we allow a long retry period for recreated tables, short for incremental sync
+        errors = []
+        max_run_time = datetime.now() + timedelta(seconds=300 if table_updated else 30)
+        while max_run_time > datetime.now():
+            # NOTE: This will fail if there are more than 10000 rows or the request size
+            # exceeds 10MB, see: https://cloud.google.com/bigquery/quotas#streaming_inserts
+            try:
+                with metrics.timer(stream, Metrics.INSERT_DURATION), profiler.stage("insert"):
+                    errors = clients[stream].insert_rows_json(table, fixed_rows, row_ids=ids)
+            except Exception as e:
+                error_string = str(e)
+                logger.warning(
+                    f"Error on insert_rows_json: {error_string}", extra={"stream": stream},
+                )
+
+                def insert_in_halves():
+                    half = len(fixed_rows) // 2
+                    with profiler.stage("insert"):
+                        return clients[stream].insert_rows_json(
+                            table, fixed_rows[:half], row_ids=ids[:half]
+                        ) + clients[stream].insert_rows_json(
+                            table, fixed_rows[half:], row_ids=ids[half:]
+                        )
+
+                google_sdk_errors = getattr(e, "errors", [])
+                if (
+                    "payload size exceeds the limit" in error_string
+                    or "too many rows present" in error_string
+                ):
+                    errors = insert_in_halves()
+                # While this is similar to the above, we want to avoid doing the json.dumps
+                # if possible, so will only do it if we didn't get the expected errors
+                elif len(json.dumps(fixed_rows)) > 9000000:
+                    errors = insert_in_halves()
+                elif (
+                    google_sdk_errors
+                    and google_sdk_errors[0].get("reason") in RETRYABLE_ERROR_CODES
+                ):
+                    # Keep the errors around so we retry until we run out of time
+                    errors = google_sdk_errors
+                else:
+                    raise e
 
-    bigquery_client = bigquery.Client(project=project_id)
-    dataset_ref = f"{project_id}.{dataset_id}"
-    dataset = bigquery.Dataset(dataset_ref)
-    if location:
-        dataset.location = location
-    bigquery_client.create_dataset(dataset, exists_ok=True)
+            if not errors:
+                break
 
-    def write_rows_to_bigquery(streams, emit_state_after_write=False):
+            metrics.increment(stream, Metrics.RETRY_COUNT)
+            pause(5 if table_updated else 1)
+
+        return errors
+
+    def finish_insert(stream, table, batch, errors, state_to_emit, log_segment):
         nonlocal failed_lines
+        metrics.increment(stream, Metrics.BATCH_COUNT)
+        if write_ahead_log:
+            # NOTE: rows which failed are logged (and in `failed_lines`), there's no point in
+            # replaying them
+            write_ahead_log.acknowledge(stream, before=log_segment)
+        if not errors:
+            logger.info(f"Loaded {len(batch)} row(s) into {table.path}")
+            state_emitter.emit(state_to_emit)
+        else:
+            failed_lines = failed_lines + batch
+            metrics.increment(stream, Metrics.FAILED_ROW_COUNT, len(batch))
+            logger.error(
+                f"Error loading row(s) into '{table.path}': {str(errors)}",
+                extra={"stream": stream},
+            )
+
+    def wait_for_inserts(max_pending=0):
+        # Inserts are completed in the order they were started (even if a later one finishes
+        # first), so a state is only emitted once every row received before it is written
+        while pending_inserts and (
+            len(pending_inserts) > max_pending or pending_inserts[0][-1].done()
+        ):
+            stream, table, batch, state_to_emit, log_segment, future = pending_inserts.popleft()
+            finish_insert(stream, table, batch, future.result(), state_to_emit, log_segment)
+
+    def write_rows_to_bigquery(streams, emit_state_after_write=False):
+        # Add up the counts of the rows received so far once per batch, not for every row
+        metrics.commit()
         for stream in streams:
             if rows[stream]:
-                # By using `insert_rows_json` and passing generated `row_ids` we avoid duplication
-                ids = [
-                    "-".join(str(row[val]) for val in key_properties[stream])
-                    for row in rows[stream]
-                ]
-
-                # Singer uses Decimal in the deserialised data which `insert_rows_json` can't
-                # serialise with the built in `json` class so we need to fix it
-                fixed_rows = [
-                    {k: (float(v) if isinstance(v, Decimal) else v) for (k, v) in row.items()}
-                    for row in rows[stream]
-                ]
-
-                # NOTE: as it turns out it takes BigQuery ~2 minutes to empty cache and acknowledge
-                # a new table schema, see: https://stackoverflow.com/a/25292028/21217
-                # So we allow a long retry period for recreated tables, short for incremental sync
-                max_run_time = datetime.now() + timedelta(
-                    seconds=300 if updated_tables.get(stream) else 30
+                batch = rows[stream]
+                ids = row_ids[stream]
+                rows[stream] = []
+                row_ids[stream] = []
+                row_positions[stream] = {}
+
+                with profiler.stage("transform"):
+                    # Singer uses Decimal in the deserialised data which `insert_rows_json` can't
+                    # serialise with the built in `json` class so we need to fix it
+                    fixed_rows = [
+                        {k: (float(v) if isinstance(v, Decimal) else v) for (k, v) in row.items()}
+                        for row in batch
+                    ]
+
+                table = tables[stream]
+                table_updated = updated_tables.pop(stream, None)
+                state_to_emit = state if emit_state_after_write else None
+                # All rows in the batch were logged in segments before the current one
+                log_segment = write_ahead_log.current if write_ahead_log else None
+
+                if insert_executor:
+                    # Wait for a free slot so we never have more than `max_inflight_inserts`
+                    wait_for_inserts(max_inflight_inserts - 1)
+                    future = insert_executor.submit(
+                        insert_rows, stream, table, fixed_rows, ids, table_updated
+                    )
+                    pending_inserts.append(
+                        (stream, table, batch, state_to_emit, log_segment, future)
+                    )
+                else:
+                    errors = insert_rows(stream, table, fixed_rows, ids, table_updated)
+                    finish_insert(stream, table, batch, errors, state_to_emit, log_segment)
+
+    def new_table(stream, schema):
+        return apply_table_options(
+            bigquery.Table(table_refs[stream], schema=schema),
+            table_options,
+            stream,
+            schema,
+            key_properties=key_properties[stream],
+            bookmark_properties=bookmark_properties[stream],
+        )
+
+    def update_table_schema(stream, new_schema, target_schema):
+        table_ref = table_refs[stream]
+
+        # Don't change the table from under any inserts which are still running
+        wait_for_inserts()
+
+        max_run_time = datetime.now() + timedelta(seconds=300)
+        while max_run_time > datetime.now():
+            # First let's try to update the schema in the existing table
+            try:
+                logger.info(f"Updating table schema: {table_ref}", extra={"stream": stream})
+                tables[stream] = clients[stream].update_table(
+                    bigquery.Table(table_ref, schema=new_schema), ["schema"]
+                )
+                logger.info(
+                    f"Updated table '{tables[stream]}' schema: {tables[stream].schema}",
+                    extra={"stream": stream},
                 )
-                while max_run_time > datetime.now():
-                    # NOTE: This will fail if there are more than 10000 rows or the request size
-                    # exceeds 10MB, see: https://cloud.google.com/bigquery/quotas#streaming_inserts
-                    try:
-                        errors[stream] = bigquery_client.insert_rows_json(
-                            tables[stream], fixed_rows, row_ids=ids
-                        )
-                    except Exception as e:
-                        error_string = str(e)
-                        logger.warning(
-                            f"Error on insert_rows_json: {error_string}", extra={"stream": stream},
-                        )
 
-                        def insert_in_halves():
-                            number_of_rows = len(fixed_rows)
-                            errors[stream] = bigquery_client.insert_rows_json(
-                                tables[stream],
-                                fixed_rows[: number_of_rows // 2],
-                                row_ids=ids[: number_of_rows // 2],
-                            )
-                            errors[stream] + bigquery_client.insert_rows_json(
-                                tables[stream],
-                                fixed_rows[number_of_rows // 2 :],
-                                row_ids=ids[number_of_rows // 2 :],
-                            )
-
-                        google_sdk_errors = getattr(e, "errors", [])
-                        if (
-                            "payload size exceeds the limit" in error_string
-                            or "too many rows present" in error_string
-                        ):
-                            insert_in_halves()
-                        # While this is similar to the above, we want to avoid doing the json.dumps
-                        # if possible, so will only do it if we didn't get the expected errors
-                        elif len(json.dumps(fixed_rows)) > 9000000:
-                            insert_in_halves()
-                        elif (
-                            google_sdk_errors
-                            and google_sdk_errors[0].get("reason") in RETRYABLE_ERROR_CODES
-                        ):
-                            pass
-                        else:
-                            raise e
-
-                    if not errors[stream]:
-                        break
-
-                    sleep(5 if updated_tables.get(stream) else 1)
-
-                if not errors[stream]:
-                    logger.info(f"Loaded {len(rows[stream])} row(s) into {tables[stream].path}")
-                    if emit_state_after_write:
-                        emit_state(state)
-                else:
-                    failed_lines = failed_lines + rows[stream]
-                    logger.error(
-                        f"Error loading row(s) into '{tables[stream].path}': {str(errors[stream])}",
+                # Mark the table updated so we know we need to retry inserting rows
+                updated_tables[stream] = True
+                break
+            except Exception as e:
+                error_string = str(e)
+                logger.warning(
+                    f"Error on updating table schema: {error_string}",
+                    extra={"stream": stream},
+                )
+
+                # If the update didn't work we can either retry or delete and recreate table
+                google_sdk_errors = getattr(e, "errors", [])
+                if (
+                    google_sdk_errors
+                    and google_sdk_errors[0].get("reason") in RETRYABLE_ERROR_CODES
+                ):
+                    pass
+                elif can_delete_table and "Provided Schema does not match" in error_string:
+                    clients[stream].delete_table(table_ref)
+                    logger.info(f"Deleted table: {table_ref}", extra={"stream": stream})
+
+                    tables[stream] = clients[stream].create_table(new_table(stream, target_schema))
+                    logger.info(
+                        f"Created table '{tables[stream]}' schema: {tables[stream].schema}",
                         extra={"stream": stream},
                     )
-                    del errors[stream]
+                    logger.info(f"Sleeping for {TABLE_CREATION_PAUSE} after creating a new table")
+                    pause(TABLE_CREATION_PAUSE)
 
-                updated_tables.pop(stream, None)
-                rows[stream] = []
+                    # Mark the table updated so we know we need to retry inserting rows
+                    updated_tables[stream] = True
+                    break
+                else:
+                    logger.warning(
+                        f"Gave up on updating table schema with error: {error_string}",
+                        extra={"stream": stream},
+                    )
+                    break
 
-    for line in lines:
-        try:
-            msg = singer.parse_message(line)
-        except json.decoder.JSONDecodeError:
-            logger.warning(f"Unable to parse line: {line}")
-            failed_lines.append(line)
-            continue
+    if write_ahead_log:
+        # Rows a previous run didn't get to write go first, it's as if the tap sent them again
+        lines = itertools.chain(write_ahead_log.replay(), lines)
 
-        if isinstance(msg, singer.RecordMessage):
-            if msg.stream not in schemas:
-                logger.warning(
-                    f"Record for stream '{msg.stream}' received before its schema!",
-                    extra={"stream": msg.stream},
-                )
+    try:
+        for line in lines:
+            try:
+                with profiler.stage("parse"):
+                    msg = singer.parse_message(line)
+            except json.decoder.JSONDecodeError:
+                logger.warning(f"Unable to parse line: {line}")
                 failed_lines.append(line)
                 continue
 
-            if validate_records:
-                validate(msg.record, schemas[msg.stream])
-
-            rows[msg.stream].append(msg.record)
-
-            state = None
+            if isinstance(msg, singer.RecordMessage):
+                if msg.stream not in schemas:
+                    logger.warning(
+                        f"Record for stream '{msg.stream}' received before its schema!",
+                        extra={"stream": msg.stream},
+                    )
+                    failed_lines.append(line)
+                    continue
+
+                if validators[msg.stream]:
+                    with profiler.stage("validate"):
+                        validators[msg.stream](msg.record)
+
+                with profiler.stage("transform"):
+                    row_id = row_id_extractors[msg.stream](msg.record)
+
+                if deduplicate_records and row_id is not None:
+                    # Only the last version of each row between two states needs to be inserted
+                    position = row_positions[msg.stream].get(row_id)
+                    if position is None:
+                        row_positions[msg.stream][row_id] = len(rows[msg.stream])
+                        rows[msg.stream].append(msg.record)
+                        row_ids[msg.stream].append(row_id)
+                    else:
+                        rows[msg.stream][position] = msg.record
+                        metrics.count(msg.stream, Metrics.DEDUPLICATED_ROW_COUNT)
+                else:
+                    rows[msg.stream].append(msg.record)
+                    row_ids[msg.stream].append(row_id)
+                metrics.count(msg.stream, Metrics.RECORD_COUNT)
+                metrics.count(msg.stream, Metrics.BYTES_RECEIVED, message_size(line))
+
+                if write_ahead_log:
+                    write_ahead_log.append_record(msg.stream, line)
+
+                state = None
+
+            elif isinstance(msg, singer.StateMessage):
+                state = msg.value
+                if write_ahead_log:
+                    write_ahead_log.append_state(line)
+                # We'll either get a stream name here or we need to have an empty string instead
+                # of None
+                full_stream = state.get("currently_syncing") or ""
+                stream = full_stream.split("-")[-1]
+                logger.debug(f"Setting state to: {state}", extra={"stream": stream})
+
+                # If we already have some rows to be written and get a new state we need to write
+                if rows.get(stream):
+                    write_rows_to_bigquery([stream], emit_state_after_write=True)
+                else:
+                    # Still emit states of inserts which have finished in the meantime
+                    wait_for_inserts(max_inflight_inserts)
+
+                # If stream in `bookmarks` doesn't have `replication_key_value` we assume this state
+                # is a first one for a particular stream and recreate table.
+                # See: https://github.com/singer-io/tap-mysql#incremental
+                rep_key = (
+                    state.get("bookmarks", {}).get(full_stream, {}).get("replication_key_value")
+                )
+                # NOTE: this will only work if `SchemaMessage` already received before
+                if stream and not rep_key:
+                    target_schema = build_schema(schemas[stream], ignore_required=True)
+                    schema_change, new_schema = diff_schema(tables[stream].schema, target_schema)
 
-        elif isinstance(msg, singer.StateMessage):
-            state = msg.value
-            # We'll either get a stream name here or we need to have an empty string instead of None
-            full_stream = state.get("currently_syncing") or ""
-            stream = full_stream.split("-")[-1]
-            logger.debug(f"Setting state to: {state}", extra={"stream": stream})
-
-            # If we already have some rows to be written and get a new state we need to write
-            if rows.get(stream):
-                write_rows_to_bigquery([stream], emit_state_after_write=True)
-
-            # If stream in `bookmarks` doesn't have `replication_key_value` we assume this state is
-            # a first one for a particular stream and recreate table.
-            # See: https://github.com/singer-io/tap-mysql#incremental
-            rep_key = state.get("bookmarks", {}).get(full_stream, {}).get("replication_key_value")
-            # NOTE: this will only work if `SchemaMessage` already received before
-            if (
-                stream
-                and not rep_key
-                and not tables[stream].schema == build_schema(schemas[stream], ignore_required=True)
-            ):
-                table_ref = f"{dataset_ref}.{stream}"
-
-                max_run_time = datetime.now() + timedelta(seconds=300)
-                while max_run_time > datetime.now():
-                    # First let's try to update the schema in the existing table
-                    try:
-                        logger.info(f"Updating table schema: {table_ref}", extra={"stream": stream})
-                        tables[stream] = bigquery_client.update_table(
-                            bigquery.Table(
-                                table_ref,
-                                schema=build_schema(schemas[stream], ignore_required=True),
-                            ),
-                            ["schema"],
-                        )
+                    if schema_change == SCHEMA_IDENTICAL:
                         logger.info(
-                            f"Updated table '{tables[stream]}' schema: {tables[stream].schema}",
+                            f"Table schema doesn't need updating: {table_refs[stream]}",
                             extra={"stream": stream},
                         )
-
-                        # Mark the table updated so we know we need to retry inserting rows
-                        updated_tables[stream] = True
-                        break
-                    except Exception as e:
-                        error_string = str(e)
+                    elif schema_change == SCHEMA_INCOMPATIBLE and not can_delete_table:
                         logger.warning(
-                            f"Error on updating table schema: {error_string}",
+                            "Gave up on updating table schema as it's incompatible with the new "
+                            f"one: {table_refs[stream]}",
                             extra={"stream": stream},
                         )
-
-                        # If the update didn't work we can either retry or delete and recreate table
-                        google_sdk_errors = getattr(e, "errors", [])
-                        if (
-                            google_sdk_errors
-                            and google_sdk_errors[0].get("reason") in RETRYABLE_ERROR_CODES
-                        ):
-                            pass
-                        elif can_delete_table and "Provided Schema does not match" in error_string:
-                            bigquery_client.delete_table(table_ref)
-                            logger.info(f"Deleted table: {table_ref}", extra={"stream": stream})
-
-                            tables[stream] = bigquery_client.create_table(
-                                bigquery.Table(
-                                    table_ref,
-                                    schema=build_schema(schemas[stream], ignore_required=True),
-                                )
-                            )
-                            logger.info(
-                                f"Created table '{tables[stream]}' schema: {tables[stream].schema}",
-                                extra={"stream": stream},
-                            )
-                            logger.info(f"Sleeping for {TABLE_CREATION_PAUSE} after creating a new table")
-                            sleep(TABLE_CREATION_PAUSE)
-
-                            # Mark the table updated so we know we need to retry inserting rows
-                            updated_tables[stream] = True
-                            break
-                        else:
-                            logger.warning(
-                                f"Gave up on updating table schema with error: {error_string}",
-                                extra={"stream": stream},
-                            )
-                            break
-
-        elif isinstance(msg, singer.SchemaMessage):
-            stream = msg.stream
-            schemas[stream] = msg.schema
-            key_properties[stream] = msg.key_properties
-            table_ref = f"{dataset_ref}.{stream}"
-            try:
-                tables[stream] = bigquery_client.get_table(table_ref)
-            except api_core.exceptions.NotFound:
-                # This will happen on the very first run
-                tables[stream] = bigquery_client.create_table(
-                    bigquery.Table(
-                        table_ref, schema=build_schema(schemas[stream], ignore_required=True)
-                    )
+                    else:
+                        update_table_schema(stream, new_schema, target_schema)
+
+            elif isinstance(msg, singer.SchemaMessage):
+                stream = msg.stream
+                if (
+                    schemas.get(stream) == msg.schema
+                    and key_properties.get(stream) == msg.key_properties
+                    and bookmark_properties.get(stream) == msg.bookmark_properties
+                ):
+                    # Taps can send the same schema again, as does the write-ahead log at the start
+                    # of each segment, so keep the rows we still have buffered for the stream
+                    if write_ahead_log:
+                        write_ahead_log.append_schema(stream, line)
+                    continue
+
+                schemas[stream] = msg.schema
+                validators[stream] = build_record_validator(
+                    msg.schema,
+                    validate_records=validate_records,
+                    validate_records_every=validate_records_every,
+                    validate_records_first=validate_records_first,
+                    type_check_records=type_check_records,
                 )
-                logger.info(f"Sleeping for {TABLE_CREATION_PAUSE} after creating a new table")
-                sleep(TABLE_CREATION_PAUSE)
+                key_properties[stream] = msg.key_properties
+                bookmark_properties[stream] = msg.bookmark_properties
+                row_id_extractors[stream] = build_row_id_extractor(msg.key_properties)
+                destination = route(stream)
+                with profiler.stage("network"):
+                    clients[stream] = client_pool.get_for(destination)
+                table_ref = f"{destination.project_id}.{destination.dataset_id}.{stream}"
+                table_refs[stream] = table_ref
+                try:
+                    with profiler.stage("network"):
+                        tables[stream] = clients[stream].get_table(table_ref)
+                except api_core.exceptions.NotFound:
+                    # This will happen on the very first run
+                    tables[stream] = clients[stream].create_table(
+                        new_table(stream, build_schema(schemas[stream], ignore_required=True))
+                    )
+                    logger.info(f"Sleeping for {TABLE_CREATION_PAUSE} after creating a new table")
+                    pause(TABLE_CREATION_PAUSE)
 
-            rows[stream] = []
-            errors[stream] = []
+                rows[stream] = []
+                row_ids[stream] = []
+                row_positions[stream] = {}
 
-        elif isinstance(msg, singer.ActivateVersionMessage):
-            # This is experimental and won't be used yet
-            pass
+                if write_ahead_log:
+                    write_ahead_log.append_schema(stream, line)
 
-        else:
-            logger.warning(f"Unrecognized message: {msg}")
-            failed_lines.append(msg)
+            elif isinstance(msg, singer.ActivateVersionMessage):
+                # This is experimental and won't be used yet
+                pass
 
-    # We shouldn't have any rows left to write, but let's try just in case
-    write_rows_to_bigquery(rows.keys())
+            else:
+                logger.warning(f"Unrecognized message: {msg}")
+                failed_lines.append(msg)
+
+        # We shouldn't have any rows left to write, but let's try just in case
+        write_rows_to_bigquery(rows.keys())
+        wait_for_inserts()
+    finally:
+        # Also when something fails, so the insert threads don't keep the process alive
+        if insert_executor:
+            insert_executor.shutdown()
+        # All the rows of a state held back are written, so it's safe to emit even on failure
+        state_emitter.flush()
+    if write_ahead_log:
+        write_ahead_log.close()
+    metrics.commit()
+    metrics.log()
 
     if failed_lines:
         logger.error(f"Number of failed lines: {len(failed_lines)}")
@@ -550,14 +1661,22 @@ def persist_lines_hybrid(
 
         state = None
 
-    bigquery_client.close()
+    if owns_client_pool:
+        client_pool.close()
 
     return state
 
 
 def collect():
+    import http.client
+    import urllib.parse
+
     try:
-        version = pkg_resources.get_distribution("target-bigquery").version
+        # NOTE: `importlib.metadata` is much quicker than `pkg_resources`, which scans every
+        # installed distribution when imported
+        from importlib.metadata import version as get_version
+
+        version = get_version("target-bigquery")
         conn = http.client.HTTPConnection("collector.singer.io", timeout=10)
         conn.connect()
         params = {
@@ -575,16 +1694,46 @@ def collect():
 
 
 def main():
-    try:
-        parser = argparse.ArgumentParser(parents=[tools.argparser])
-        parser.add_argument("-c", "--config", help="Config file", required=True)
-        flags = parser.parse_args()
-    except ImportError:
-        flags = None
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="Config file", required=True)
+    parser.add_argument("--profile", help="Write a profiling report to this file on exit")
+    parser.add_argument("--capture", help="Also write the input to this gzipped file to replay")
+    parser.add_argument("--replay", help="Read the input from a file written by --capture")
+    parser.add_argument(
+        "--replay-pace",
+        choices=["max", "original"],
+        default="max",
+        help="Replay as fast as possible or at the pace the input was captured",
+    )
+    # These used to come from `oauth2client.tools.argparser`, which is slow to import and unused,
+    # we still accept them so existing commands keep working
+    parser.add_argument("--auth_host_name", help=argparse.SUPPRESS)
+    parser.add_argument("--noauth_local_webserver", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--auth_host_port", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--logging_level", help=argparse.SUPPRESS)
+    flags = parser.parse_args()
+    if (
+        flags.auth_host_name
+        or flags.noauth_local_webserver
+        or flags.auth_host_port
+        or flags.logging_level
+    ):
+        logger.warning(
+            "The oAuth flow flags are ignored, credentials come from Application Default "
+            "Credentials (ie `GOOGLE_APPLICATION_CREDENTIALS`)"
+        )
 
     with open(flags.config) as input:
         config = json.load(input)
 
+    profile_report = flags.profile or config.get("profile")
+    if profile_report:
+        profiler.start(
+            profile_report,
+            use_cprofile=config.get("profile_cprofile", False),
+            tracemalloc_interval=config.get("profile_tracemalloc_interval"),
+        )
+
     if not config.get("disable_collection", False):
         logger.info(
             "Sending version information to stitchdata.com. "
@@ -595,7 +1744,39 @@ def main():
 
     validate_records = config.get("validate_records", True)
 
-    input = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+    max_inflight_inserts = config.get("max_inflight_inserts", 1)
+
+    # A single client (and so a single connection pool) is shared by every stream going to the
+    # same project and location
+    if config.get("client_factory"):
+        client_pool = ClientPool(load_client_factory(config["client_factory"]))
+    else:
+        client_pool = ClientPool(
+            pool_size=config.get("http_pool_size", max(10, max_inflight_inserts)),
+            keepalive=config.get("http_keepalive", True),
+            request_timeout=config.get("request_timeout"),
+            upload_chunk_size=config.get("upload_chunk_size"),
+        )
+
+    metrics = Metrics(
+        log_interval=config.get("metrics_log_interval", 60),
+        textfile=config.get("metrics_textfile"),
+        textfile_format=config.get("metrics_textfile_format", "json"),
+    )
+
+    if flags.replay:
+        input = replay_lines(flags.replay, pace=flags.replay_pace)
+    else:
+        input = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+
+    capture_file = flags.capture or config.get("capture_file")
+    if capture_file:
+        input = capture_lines(input, capture_file)
+
+    state_emitter = StateEmitter(
+        min_interval=config.get("state_emit_interval", 0),
+        every=config.get("state_emit_every", 1),
+    )
 
     if config.get("replication_method") == "HYBRID":
         state = persist_lines_hybrid(
@@ -603,14 +1784,37 @@ def main():
             config["dataset_id"],
             input,
             validate_records=validate_records,
+            validate_records_every=config.get("validate_records_every"),
+            validate_records_first=config.get("validate_records_first"),
+            type_check_records=config.get("type_check_records", False),
             location=config.get("location"),
+            max_inflight_inserts=max_inflight_inserts,
+            deduplicate_records=config.get("deduplicate_records", False),
+            write_ahead_log_dir=config.get("write_ahead_log_dir"),
+            write_ahead_log_fsync=config.get("write_ahead_log_fsync", False),
+            client_pool=client_pool,
+            destinations=config.get("destinations"),
+            state_emitter=state_emitter,
+            metrics=metrics,
+            table_options=config.get("table_options"),
             # NOTE: this option shouldn't be used until this BigQuery bug is fixed:
             # https://issuetracker.google.com/issues/152476581
             can_delete_table=config.get("delete_table_on_incompatible_schema", False),
         )
     elif config.get("stream_data", True):
         state = persist_lines_stream(
-            config["project_id"], config["dataset_id"], input, validate_records=validate_records
+            config["project_id"],
+            config["dataset_id"],
+            input,
+            validate_records=validate_records,
+            validate_records_every=config.get("validate_records_every"),
+            validate_records_first=config.get("validate_records_first"),
+            type_check_records=config.get("type_check_records", False),
+            location=config.get("location"),
+            client_pool=client_pool,
+            destinations=config.get("destinations"),
+            metrics=metrics,
+            table_options=config.get("table_options"),
         )
     else:
         state = persist_lines_job(
@@ -619,8 +1823,18 @@ def main():
             input,
             truncate=config.get("replication_method") == "FULL_TABLE",
             validate_records=validate_records,
+            validate_records_every=config.get("validate_records_every"),
+            validate_records_first=config.get("validate_records_first"),
+            type_check_records=config.get("type_check_records", False),
+            location=config.get("location"),
+            client_pool=client_pool,
+            destinations=config.get("destinations"),
+            metrics=metrics,
+            table_options=config.get("table_options"),
         )
 
+    client_pool.close()
+
     emit_state(state)
     logger.debug("Exiting normally")
 
@@ -1,8 +1,32 @@
 import os
+import pytest
+import subprocess
+import sys
+import threading
 import simplejson as json
 from decimal import Decimal
 
-from target_bigquery import persist_lines_hybrid
+import target_bigquery
+from benchmark.fake_bigquery import FakeClient
+from benchmark.generate import generate_lines
+from benchmark.importtime import LAZY_MODULES
+from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField
+from jsonschema import ValidationError
+from target_bigquery import (
+    SCHEMA_ADDITIVE,
+    SCHEMA_IDENTICAL,
+    SCHEMA_INCOMPATIBLE,
+    SCHEMA_RELAXATION,
+    ClientPool,
+    Metrics,
+    apply_table_options,
+    StateEmitter,
+    build_record_validator,
+    build_row_id_extractor,
+    diff_schema,
+    persist_lines_hybrid,
+)
 
 
 test_path = os.path.dirname(os.path.realpath(__file__))
@@ -53,7 +77,7 @@ def test_hybrid_multiple_runs(setup_bigquery_and_config, check_bigquery, do_sync
     # A new, incompatible schema which can still work (ie deleted column)
     stdout, stderr = do_sync(f"{test_path}/tap-sample-column-delete.json", config_filename)
 
-    assert [log for log in stderr if "Gave up on updating table schema" in log]
+    assert [log for log in stderr if "Table schema doesn't need updating" in log]
     assert 'version": 1793427040000' in stdout[0]
     assert check_bigquery(bigquery_client, table, lambda data: len(data) == 17)
 
@@ -212,6 +236,461 @@ def test_full_table(setup_bigquery_and_config, check_bigquery, do_sync):
     assert check_bigquery(bigquery_client, table, lambda data: len(data) == 6)
 
 
+def test_hybrid_concurrent_inserts_emit_states_in_order(fake_bigquery, capsys):
+    lines = generate_lines(streams=2, rows=100, state_every=10)
+
+    client = fake_bigquery(lines, client=FakeClient(latency=0.01), max_inflight_inserts=4)
+
+    states = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    replication_key_values = [
+        bookmark["replication_key_value"]
+        for state in states
+        for bookmark in state["bookmarks"].values()
+    ]
+    assert replication_key_values == [*range(9, 100, 10)] * 2
+    assert len(client.rows["fake-project.benchmark.stream_0"]) == 100
+    assert len(client.rows["fake-project.benchmark.stream_1"]) == 100
+
+
+def test_hybrid_concurrent_inserts_shut_down_on_failure(fake_bigquery, monkeypatch):
+    executors = []
+
+    class RecordingExecutor(target_bigquery.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            executors.append(self)
+
+    monkeypatch.setattr(target_bigquery, "ThreadPoolExecutor", RecordingExecutor)
+    client = FakeClient()
+    lines = [*generate_lines(rows=20, state_every=10)]
+    lines.insert(-1, json.dumps({"type": "RECORD", "stream": "stream_0", "record": {"id": "x"}}))
+
+    with pytest.raises(ValidationError):
+        fake_bigquery(lines, client=client, max_inflight_inserts=4)
+
+    assert len(executors) == 1 and executors[0]._shutdown
+    assert len(client.rows["fake-project.benchmark.stream_0"]) == 20
+
+
+def test_build_bigquery_client(monkeypatch):
+    import socket
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import bigquery
+
+    requests = []
+    monkeypatch.setattr(google.auth, "default", lambda scopes: (AnonymousCredentials(), None))
+    monkeypatch.setattr(
+        AuthorizedSession, "request", lambda self, *args, **kwargs: requests.append(kwargs)
+    )
+    monkeypatch.setattr(bigquery.client, "_DEFAULT_CHUNKSIZE", bigquery.client._DEFAULT_CHUNKSIZE)
+
+    client = target_bigquery.build_bigquery_client(
+        "project", pool_size=32, request_timeout=5, upload_chunk_size=1024 * 1024
+    )
+
+    adapter = client._http.adapters["https://"]
+    assert adapter._pool_maxsize == 32
+    socket_options = adapter.poolmanager.connection_pool_kw["socket_options"]
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in socket_options
+    assert bigquery.client._DEFAULT_CHUNKSIZE == 1024 * 1024
+
+    client._http.request("GET", "https://bigquery.googleapis.com")
+    client._http.request("GET", "https://bigquery.googleapis.com", timeout=60)
+    assert [kwargs["timeout"] for kwargs in requests] == [5, 60]
+
+
+def test_hybrid_routes_streams_to_destinations(fake_bigquery):
+    client_pool = ClientPool(FakeClient)
+    lines = generate_lines(streams=3, rows=10)
+
+    fake_bigquery(
+        lines,
+        client_pool=client_pool,
+        destinations=[
+            {"streams": "stream_[01]", "dataset_id": "tenants"},
+            {"streams": ["stream_1", "stream_2"], "project_id": "other-project", "location": "EU"},
+        ],
+    )
+
+    client = client_pool.clients["fake-project", None]
+    other_client = client_pool.clients["other-project", "EU"]
+    assert len(client_pool.clients) == 2
+    assert client.calls["create_dataset"] == other_client.calls["create_dataset"] == 1
+    assert len(client.rows["fake-project.tenants.stream_0"]) == 10
+    assert len(client.rows["fake-project.tenants.stream_1"]) == 10
+    assert len(other_client.rows["other-project.benchmark.stream_2"]) == 10
+
+
+def test_hybrid_state_emitter_holds_back_states(fake_bigquery, capsys):
+    fake_bigquery(generate_lines(rows=100, state_every=10), state_emitter=StateEmitter(every=4))
+
+    states = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [
+        state["bookmarks"]["benchmark-public-stream_0"]["replication_key_value"] for state in states
+    ] == [39, 79, 99]
+
+
+def test_hybrid_state_emitter_flushes_on_failure(fake_bigquery, capsys):
+    lines = [*generate_lines(rows=100, state_every=10)]
+    failing_at = next(i for i, line in enumerate(lines) if '"replication_key_value": 69' in line)
+    lines.insert(
+        failing_at + 1, json.dumps({"type": "RECORD", "stream": "stream_0", "record": {"id": "x"}})
+    )
+
+    with pytest.raises(ValidationError):
+        fake_bigquery(lines, state_emitter=StateEmitter(every=4))
+
+    states = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [
+        state["bookmarks"]["benchmark-public-stream_0"]["replication_key_value"] for state in states
+    ] == [39, 69]
+
+
+def test_slow_modules_are_not_imported_on_start_up():
+    imported = subprocess.run(
+        [sys.executable, "-c", "import sys, target_bigquery; print(' '.join(sys.modules))"],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8")
+
+    assert not set(LAZY_MODULES) & set(imported.split())
+
+
+def test_hybrid_deduplicate_records(fake_bigquery):
+    lines = [*generate_lines(rows=0)][:2] + [
+        json.dumps({"type": "RECORD", "stream": "stream_0", "record": {"id": i % 3, "version": i}})
+        for i in range(10)
+    ]
+
+    client = fake_bigquery(lines, validate_records=False, deduplicate_records=True)
+
+    assert client.rows["fake-project.benchmark.stream_0"] == [
+        {"id": 0, "version": 9},
+        {"id": 1, "version": 7},
+        {"id": 2, "version": 8},
+    ]
+
+
+def test_hybrid_write_ahead_log_replay(fake_bigquery, monkeypatch, tmp_path):
+    lines = [*generate_lines(rows=25, state_every=10)]
+
+    # The target dies while writing the second batch of rows
+    crashing_client = FakeClient()
+    insert_rows_json = crashing_client.insert_rows_json
+
+    def crash_on_second_insert(*args, **kwargs):
+        if crashing_client.calls["insert_rows_json"]:
+            raise KeyboardInterrupt()
+        return insert_rows_json(*args, **kwargs)
+
+    monkeypatch.setattr(crashing_client, "insert_rows_json", crash_on_second_insert)
+    with pytest.raises(KeyboardInterrupt):
+        fake_bigquery(lines, client=crashing_client, write_ahead_log_dir=str(tmp_path))
+    assert len(crashing_client.rows["fake-project.benchmark.stream_0"]) == 10
+
+    # The rows which weren't written are replayed before reading any new input
+    client = fake_bigquery([], write_ahead_log_dir=str(tmp_path))
+    assert [row["id"] for row in client.rows["fake-project.benchmark.stream_0"]] == [*range(10, 20)]
+    assert not os.listdir(tmp_path)
+
+
+def test_hybrid_write_ahead_log_replay_rows_buffered_across_states(
+    fake_bigquery, monkeypatch, tmp_path
+):
+    schemas = [line for line in generate_lines(streams=2, rows=0) if '"SCHEMA"' in line]
+    lines = [*schemas]
+    for i in range(6):
+        for stream in ["stream_0", "stream_1"]:
+            lines.append(json.dumps({"type": "RECORD", "stream": stream, "record": {"id": i}}))
+        if i % 2:
+            # Without `currently_syncing` the rows stay buffered until the end
+            lines.append(json.dumps({"type": "STATE", "value": {"bookmarks": {}}}))
+
+    # The target dies on its first insert, at the end, so every row is only in the log
+    crashing_client = FakeClient()
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(crashing_client, "insert_rows_json", crash)
+    with pytest.raises(KeyboardInterrupt):
+        fake_bigquery(lines, client=crashing_client, write_ahead_log_dir=str(tmp_path))
+
+    client = fake_bigquery([], write_ahead_log_dir=str(tmp_path))
+    for stream in ["stream_0", "stream_1"]:
+        rows = client.rows[f"fake-project.benchmark.{stream}"]
+        assert [row["id"] for row in rows] == [*range(6)]
+    assert not os.listdir(tmp_path)
+
+
+def test_capture_and_replay(fake_bigquery, tmp_path):
+    capture_file = str(tmp_path / "capture.gz")
+    lines = [*generate_lines(streams=2, rows=500, state_every=100)]
+
+    client = fake_bigquery(target_bigquery.capture_lines(lines, capture_file))
+    replayed_client = fake_bigquery(target_bigquery.replay_lines(capture_file))
+    assert replayed_client.rows == client.rows
+
+    # A capture cut off by a crash is replayed up to where it ends
+    with open(capture_file, "rb") as f:
+        data = f.read()
+    with open(capture_file, "wb") as f:
+        f.write(data[: len(data) // 2])
+    replayed_lines = [line.rstrip("\n") for line in target_bigquery.replay_lines(capture_file)]
+    assert 0 < len(replayed_lines) < len(lines)
+    assert replayed_lines == lines[: len(replayed_lines)]
+
+
+def test_row_ids():
+    row_id = build_row_id_extractor(["a", "b"])
+
+    assert row_id({"a": "x-y", "b": "z"}) != row_id({"a": "x", "b": "y-z"})
+    assert row_id({"a": 1, "b": Decimal("1.5")}) == row_id({"b": Decimal("1.5"), "a": 1})
+    assert row_id({"a": 1, "b": 1}) != row_id({"a": "1", "b": 1})
+    assert len(row_id({"a": "a" * 1000, "b": 1})) == len(row_id({"a": "a" * 2000, "b": 1})) == 32
+    assert row_id({"b": 1}) is None
+    assert build_row_id_extractor([])({"a": 1}) is None
+
+
+def test_hybrid_deduplicate_records_missing_key(fake_bigquery):
+    lines = [*generate_lines(rows=0)][:2] + [
+        json.dumps({"type": "RECORD", "stream": "stream_0", "record": {"version": i}})
+        for i in range(5)
+    ]
+
+    client = fake_bigquery(lines, validate_records=False, deduplicate_records=True)
+
+    assert len(client.rows["fake-project.benchmark.stream_0"]) == 5
+
+
+def test_record_validator():
+    schema = {
+        "properties": {
+            "id": {"type": "integer"},
+            "name": {"type": ["null", "string"], "maxLength": 3},
+            "price": {"type": "number"},
+        }
+    }
+
+    type_check = build_record_validator(schema, validate_records=False, type_check_records=True)
+    type_check({"id": 1, "name": "long name", "price": Decimal("1.5")})
+    for record in [{"id": "1"}, {"id": True}, {"name": 1}, {"price": False}]:
+        with pytest.raises(ValidationError):
+            type_check(record)
+
+    validate_sample = build_record_validator(
+        schema, validate_records_every=3, validate_records_first=2
+    )
+    failed = []
+    for i in range(10):
+        try:
+            validate_sample({"name": "long name"})
+        except ValidationError:
+            failed.append(i)
+    assert failed == [0, 1, 3, 6, 9]
+
+    assert build_record_validator(schema, validate_records=False) is None
+
+
+def test_diff_schema():
+    current = [
+        SchemaField("id", "INTEGER", mode="REQUIRED"),
+        SchemaField("name", "STRING"),
+        SchemaField("asset", "STRING"),
+    ]
+
+    # Order, deleted columns and standard SQL type names don't need an update
+    assert diff_schema(
+        current,
+        [SchemaField("name", "string"), SchemaField("id", "INT64", mode="REQUIRED")],
+    ) == (SCHEMA_IDENTICAL, current)
+
+    change, new_schema = diff_schema(current, [*current, SchemaField("deleted", "BOOLEAN")])
+    assert change == SCHEMA_ADDITIVE
+    assert [field.name for field in new_schema] == ["id", "name", "asset", "deleted"]
+
+    change, new_schema = diff_schema(current, [SchemaField("id", "INTEGER")])
+    assert change == SCHEMA_RELAXATION
+    assert new_schema[0].mode == "NULLABLE"
+
+    assert diff_schema(current, [SchemaField("id", "STRING")])[0] == SCHEMA_INCOMPATIBLE
+
+
+def test_profiler_report(fake_bigquery, monkeypatch, tmp_path):
+    monkeypatch.setattr(target_bigquery, "TABLE_CREATION_PAUSE", 0.01)
+    monkeypatch.setattr(target_bigquery.atexit, "register", lambda function: None)
+    profiler = target_bigquery.Profiler()
+    monkeypatch.setattr(target_bigquery, "profiler", profiler)
+    report_file = tmp_path / "profile.txt"
+    profiler.start(str(report_file))
+
+    fake_bigquery(generate_lines(rows=10))
+    profiler.write_report()
+
+    stages = {line.split()[0] for line in report_file.read_text().splitlines() if "call(s)" in line}
+    assert stages == {"parse", "validate", "transform", "insert", "network", "sleep"}
+
+
+def test_apply_table_options():
+    schema = [
+        SchemaField("id", "INTEGER", mode="REQUIRED"),
+        SchemaField("price", "FLOAT"),
+        SchemaField("tags", "STRING", mode="REPEATED"),
+        SchemaField("updated_at", "TIMESTAMP"),
+    ]
+    options = {"*": {"partition_expiration_days": 0.5}, "ingested": {"partition_field": None}}
+
+    table = apply_table_options(
+        bigquery.Table("fake-project.benchmark.defaults", schema=schema),
+        options,
+        "defaults",
+        schema,
+        key_properties=["id", "price", "tags"],
+        bookmark_properties=["updated_at"],
+    )
+    assert table.time_partitioning.type_ == "DAY"
+    assert table.time_partitioning.field == "updated_at"
+    assert table.time_partitioning.expiration_ms == 12 * 60 * 60 * 1000
+    assert isinstance(table.time_partitioning.expiration_ms, int)
+    # Floats and repeated fields can't be clustered on
+    assert table.clustering_fields == ["id"]
+
+    table = apply_table_options(
+        bigquery.Table("fake-project.benchmark.ingested", schema=schema),
+        options,
+        "ingested",
+        schema,
+        bookmark_properties=["updated_at"],
+    )
+    assert table.time_partitioning.field is None
+    assert table.clustering_fields is None
+
+    table = apply_table_options(
+        bigquery.Table("fake-project.benchmark.empty", schema=schema),
+        {"empty": {}},
+        "empty",
+        schema,
+        key_properties=["id"],
+        bookmark_properties=["updated_at"],
+    )
+    assert table.time_partitioning.field == "updated_at"
+    assert table.time_partitioning.expiration_ms is None
+    assert table.clustering_fields == ["id"]
+
+    table = apply_table_options(
+        bigquery.Table("fake-project.benchmark.plain", schema=schema), None, "plain", schema
+    )
+    assert table.time_partitioning is None
+
+
+def test_job_table_options_only_apply_to_new_tables(fake_bigquery, monkeypatch):
+    client = FakeClient()
+    job_configs = []
+    load_table_from_file = client.load_table_from_file
+
+    def record_job_config(*args, job_config=None, **kwargs):
+        job_configs.append(job_config)
+        return load_table_from_file(*args, job_config=job_config, **kwargs)
+
+    monkeypatch.setattr(client, "load_table_from_file", record_job_config)
+
+    for _ in range(2):
+        fake_bigquery(
+            generate_lines(rows=10),
+            target_bigquery.persist_lines_job,
+            client=client,
+            table_options={"*": {}},
+        )
+
+    assert job_configs[0].time_partitioning is not None
+    assert job_configs[1].time_partitioning is None
+
+
+def test_job_does_not_create_datasets(fake_bigquery):
+    client = fake_bigquery(generate_lines(rows=10), target_bigquery.persist_lines_job)
+
+    # Service accounts with only dataset level roles can't create datasets
+    assert not client.calls["create_dataset"]
+    assert client.calls["load_table_from_file"] == 1
+
+
+def test_metrics_count_and_commit():
+    metrics = Metrics()
+
+    metrics.count("fruitimals", Metrics.RECORD_COUNT)
+    metrics.count("fruitimals", Metrics.RECORD_COUNT, 2)
+    assert not metrics.counters
+
+    metrics.commit()
+    metrics.increment("fruitimals", Metrics.RECORD_COUNT)
+    assert metrics.counters["fruitimals", Metrics.RECORD_COUNT] == 4
+
+
+def test_metrics_textfile(tmp_path):
+    textfile = tmp_path / "metrics.prom"
+    metrics = Metrics(textfile=str(textfile), textfile_format="prometheus")
+
+    metrics.increment("fruitimals", Metrics.RECORD_COUNT, 3)
+    metrics.observe("fruitimals", Metrics.INSERT_DURATION, 0.2)
+    metrics.log()
+
+    lines = textfile.read_text().splitlines()
+    histogram = "target_bigquery_insert_duration_seconds"
+    assert 'target_bigquery_record_count{stream="fruitimals"} 3' in lines
+    assert f'{histogram}_bucket{{stream="fruitimals",le="0.1"}} 0' in lines
+    assert f'{histogram}_bucket{{stream="fruitimals",le="0.25"}} 1' in lines
+    assert f'{histogram}_count{{stream="fruitimals"}} 1' in lines
+
+
+@pytest.mark.parametrize(
+    "persist_lines",
+    [
+        target_bigquery.persist_lines_hybrid,
+        target_bigquery.persist_lines_stream,
+        target_bigquery.persist_lines_job,
+    ],
+)
+def test_metrics_bytes_received(fake_bigquery, persist_lines):
+    metrics = Metrics()
+    lines = [*generate_lines(rows=0)][:2] + [
+        json.dumps(
+            {"type": "RECORD", "stream": "stream_0", "record": {"id": i, "name": "é"}},
+            ensure_ascii=False,
+        )
+        for i in range(3)
+    ]
+
+    fake_bigquery(lines, persist_lines, validate_records=False, metrics=metrics)
+
+    assert metrics.counters["stream_0", Metrics.BYTES_RECEIVED] == sum(
+        len(line.encode("utf-8")) for line in lines[2:]
+    )
+
+
+def test_metrics_textfile_from_several_threads(monkeypatch, tmp_path):
+    textfile = tmp_path / "metrics.json"
+    metrics = Metrics(log_interval=0, textfile=str(textfile))
+
+    def increment():
+        for _ in range(50):
+            metrics.increment("fruitimals", Metrics.RETRY_COUNT)
+
+    errors = []
+    monkeypatch.setattr(threading, "excepthook", lambda args: errors.append(args.exc_value))
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.log()
+
+    assert not errors
+    assert json.loads(textfile.read_text())["streams"]["fruitimals"]["retry_count"] == 400
+    assert os.listdir(tmp_path) == ["metrics.json"]
+
+
 # This case currently fails until this is fixed: https://issuetracker.google.com/issues/152476581
 # def test_hybrid_with_full_table_reset(setup_bigquery_and_config, check_bigquery, do_sync):
 #     project_id, bigquery_client, config_filename, dataset_id = setup_bigquery_and_config()